@@ -42,7 +42,7 @@ ERRORS:
 
 """
 
-from Sensor import Sensor, RefreshRate
+from Sensor import Sensor, RefreshRate, RateController, TemporalFilter
 from Windows import Screen
 from Data import Payload
 import _thread
@@ -90,11 +90,45 @@ def core1_thread():
   
     global data_bus
   
+    def show_operating_point(controller):
+        # Settings page, sensor field
+        data_bus.pages[1]['fields'][4]['value'] = controller.label()
+
+    spot = [None]
+
+    def follow_spot(record):
+        # opt-in: convert only a 3x3 region around the selected spot, plus a coarse background
+        index = data_bus.spot_index if data_bus.configs.auto_roi else None
+        if index != spot[0]:
+            switched = (index is None) != (spot[0] is None)
+            spot[0] = index
+            sensor.clear_regions()
+            if index is not None:
+                sensor.add_region((index & 0x1f) - 1, (index >> 5) - 1, 3, 3)
+            if switched:
+                # ROI on/off changes the conversion cost: measure it afresh
+                sensor.rate_controller.reset()
+
+    def follow_settings(record):
+        # denoise frames while enabled on the Modes page
+        enabled = data_bus.pages[3]['fields'][4]['value']
+        if enabled != (sensor.temporal_filter is not None):
+            data_bus.configs.temporal_filter = enabled
+            sensor.temporal_filter = TemporalFilter() if enabled else None
+        follow_spot(record)
+
     def setup_sensor():
         if data_bus.configs.interpolate_pixels:
-            sensor.refresh_rate = RefreshRate.REFRESH_0_5_HZ
+            rate = RefreshRate.REFRESH_0_5_HZ
         else:    
-            sensor.refresh_rate = RefreshRate.REFRESH_2_HZ
+            rate = RefreshRate.REFRESH_2_HZ
+        # start there and let the controller find the fastest sustainable rate and I2C clock
+        sensor.rate_controller = RateController(sensor, rate, callback=show_operating_point)
+        if data_bus.configs.temporal_filter:
+            sensor.temporal_filter = TemporalFilter()
+        sensor.progressive = data_bus.configs.progressive
+        sensor.set_roi_grid(4)
+        sensor.full_refresh_frames = 8
     
     # launch sensor
     sensor = Sensor()
@@ -103,7 +137,7 @@ def core1_thread():
     setup_sensor()
 
     # run sensor
-    sensor.loop()
+    sensor.loop(follow_settings)
     
     # Core 1 ends here
 
@@ -72,6 +72,8 @@ FIELD_ZONES = const(3)      # Number of toucheable zones in a field
 
 FIELD_TO_STRIP_DELTA = 8      # (40 - 32)
 
+PALETTE_STEPS = const(256)  # RGB565 palette steps for calculated colors
+
 TEXT_STEP = FIELD_STEP // 2
 
 MAX_FIELD_CHAR = FRAME_STEP // 8
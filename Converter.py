@@ -0,0 +1,288 @@
+"""
+Thermal camera
+================================================================================
+
+Bulk offline temperature converter (PC only: NumPy):
+
+
+* Author(s): Paulo Teixeira
+
+
+Implementation Notes
+--------------------
+
+    Converts a Recorder log into temperatures with the maths of
+    Sensor._UpdateContext and Sensor._CalculateTo, vectorised over pixels and
+    subpages with NumPy and spread over a process pool, one chunk of records
+    per task.
+
+    The calibration comes from Sensor._ExtractParameters itself, run on the
+    log's EEPROM through Simulator.SimulatedI2C, so driver and converter
+    cannot drift apart.
+
+    Pixels whose raw word is out of range (eg. saturated, see
+    Sensor.RAW_LIMIT) are patched from their neighbours like bad pixels, as
+    the driver does; --check runs both on synthetic subpages with saturated
+    pixels and compares them.
+
+    The output is a float32 .npy file, memory-mapped while it is written, with
+    one 768-pixel row per recorded subpage: like the driver's frame buffer,
+    each row holds the pixels of its subpage and keeps the other subpage from
+    the rows before it.
+
+    Usage:
+
+        python Converter.py session.mlx session.npy --emissivity 0.95
+        python Converter.py check.mlx check.npy --check
+
+"""
+
+import argparse
+import os
+import struct
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+import Simulator
+from Sensor import Sensor, OPENAIR_TA_SHIFT, RAW_LIMIT, frame_buffers
+from Recorder import Recorder, LogReader, LOG_HEADER, EEPROM_WORDS, RECORD_WORDS
+
+CHUNK_RECORDS = 1024                        # subpages per pool task
+DATA_OFFSET = struct.calcsize(LOG_HEADER) + 2 * EEPROM_WORDS
+CHECK_FRAMES = 4                            # frames recorded by --check
+CHECK_SATURATED = (201, 202, 500)           # pixels saturated by --check
+CHECK_TOLERANCE = 1e-3                      # degC, float32 output
+
+
+class Calibration:
+    """
+        Sensor calibration as NumPy arrays, extracted by the driver from an
+        EEPROM image
+    """
+
+    def __init__(self, eeprom, interpolate_bad_pixels=True):
+        sensor = Sensor(calibration_cache=False, i2c=Simulator.SimulatedI2C(eeprom))
+        for name in Sensor._cacheIntegers + Sensor._cacheFloats:
+            setattr(self, name, getattr(sensor, name))
+        for name in Sensor._cacheLists:
+            setattr(self, name, np.array(getattr(sensor, name), dtype=np.float64))
+        self.offset = np.array(sensor.offset, dtype=np.float64)
+        self.kta = np.array(sensor.ktaTable, dtype=np.float64)
+        self.kv = np.array(sensor.kvTable, dtype=np.float64)
+        self.alpha = np.array(sensor.alphaTable, dtype=np.float64)
+        self.ilChess = np.array(sensor.ilChessTable, dtype=np.float64)
+        # good pixels of [mode][subpage], bad pixels with their neighbours
+        self.pixels = np.zeros((2, 2, 768), dtype=bool)
+        self.neighbours = None
+        if interpolate_bad_pixels:
+            self.neighbours = [np.array(sensor._GoodNeighbours(pixel), dtype=np.intp) for pixel in range(768)]
+        self.badPixels = [[[], []], [[], []]]
+        for mode in range(2):
+            for subPage in range(2):
+                self.pixels[mode, subPage, np.array(sensor.subPagePixels[mode][subPage], dtype=np.intp)] = True
+                for pixel, neighbours in sensor.subPageBadPixels[mode][subPage]:
+                    neighbours = np.array(neighbours, dtype=np.intp) if interpolate_bad_pixels else None
+                    self.badPixels[mode][subPage].append((pixel, neighbours))
+
+
+def signed(words):
+    return words.astype(np.int32) - ((words.astype(np.int32) & 0x8000) << 1)
+
+
+def out_of_range(frame):
+    """Pixels whose raw word is out of range, in the RAM of one or more frames:
+    those of the other subpage are its last reading, as in the driver"""
+    raw = frame[..., :768]
+    return (raw > RAW_LIMIT) & (raw < 0x10000 - RAW_LIMIT)
+
+
+def calculate_to(cal, records, emissivity, reflected_temperature):
+    """Temperatures of records, an (n, RECORD_WORDS) uint16 array, as an
+    (n, 768) float32 array with NaN outside the good pixels of each subpage
+    and on the out-of-range ones"""
+    frame = records[:, 2:]
+    control = frame[:, 832].astype(np.int32)
+    subPage = frame[:, 833].astype(np.intp) & 1
+    mode = (control & 0x1000) >> 12
+
+    # --------- _UpdateContext, one value per subpage ----------------------
+    resolutionRAM = (control & 0x0C00) >> 10
+    vdd = ((2.0 ** cal.resolutionEE / 2.0 ** resolutionRAM) * signed(frame[:, 810]) - cal.vdd25) / cal.kVdd + 3.3
+    ptat = signed(frame[:, 800])
+    ptatArt = ptat / (ptat * cal.alphaPTAT + signed(frame[:, 768])) * 262144
+    ta = (ptatArt / (1 + cal.KvPTAT * (vdd - 3.3)) - cal.vPTAT25) / cal.KtPTAT + 25
+    tr = ta - OPENAIR_TA_SHIFT if reflected_temperature is None else np.full_like(ta, reflected_temperature)
+    dTa = ta - 25
+    dVdd = vdd - 3.3
+
+    ta4 = (ta + 273.15) ** 4
+    tr4 = (tr + 273.15) ** 4
+    taTr = tr4 - (tr4 - ta4) / emissivity
+
+    ksTo, ct = cal.ksTo, cal.ct
+    alphaCorrR = np.array([1 / (1 + ksTo[0] * 40), 1, 1 + ksTo[1] * ct[2], 0])
+    alphaCorrR[3] = alphaCorrR[2] * (1 + ksTo[2] * (ct[3] - ct[2]))
+
+    gain = cal.gainEE / signed(frame[:, 778])
+    cpCorrection = (1 + cal.cpKta * dTa) * (1 + cal.cpKv * dVdd)
+    ilChessCorrection = (mode << 7) != cal.calibrationModeEE
+    irDataCP0 = signed(frame[:, 776]) * gain - cal.cpOffset[0] * cpCorrection
+    irDataCP1 = (signed(frame[:, 808]) * gain
+                 - (cal.cpOffset[1] + np.where(ilChessCorrection, cal.ilChessC[0], 0)) * cpCorrection)
+    tgcCP = cal.tgc * np.where(subPage == 0, irDataCP0, irDataCP1)
+
+    # --------- _CalculateTo, (subpages, pixels) ---------------------------
+    column = np.newaxis
+    irData = signed(frame[:, :768]) * gain[:, column]
+    irData -= cal.offset * (1 + cal.kta * dTa[:, column]) * (1 + cal.kv * dVdd[:, column])
+    irData += np.where(ilChessCorrection[:, column], cal.ilChess, 0)
+    irData -= tgcCP[:, column]
+    irData /= emissivity
+
+    alphaCompensated = cal.alpha * (1 + cal.KsTa * dTa)[:, column]
+    taTr = taTr[:, column]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        Sx = alphaCompensated ** 3 * (irData + alphaCompensated * taTr)
+        Sx = np.sqrt(np.sqrt(Sx)) * ksTo[1]
+        To = np.sqrt(np.sqrt(irData / (alphaCompensated * (1 - ksTo[1] * 273.15) + Sx) + taTr)) - 273.15
+
+        torange = np.searchsorted(ct[1:4], To, side='right')
+        To = np.sqrt(np.sqrt(
+            irData / (alphaCompensated * alphaCorrR[torange] * (1 + ksTo[torange] * (To - ct[torange]))) + taTr
+        )) - 273.15
+
+    To[~cal.pixels[mode, subPage] | out_of_range(frame)] = np.nan
+    return To.astype(np.float32)
+
+
+def complete_row(cal, row, previous, control, subPage, outOfRange):
+    """Keeps the other subpage from previous, then fills this subpage's
+    out-of-range pixels (outOfRange: out_of_range of its frame) with their
+    in-range neighbours' mean, and its bad pixels with their neighbours' mean
+    (or -273.15), like the driver"""
+    mode = (int(control) & 0x1000) >> 12
+    subPage = int(subPage) & 1
+    if previous is not None:
+        holes = np.isnan(row)
+        row[holes] = previous[holes]
+    for pixel in np.flatnonzero(outOfRange & cal.pixels[mode, subPage]):
+        neighbours = None if cal.neighbours is None else cal.neighbours[pixel]
+        if neighbours is not None:
+            neighbours = neighbours[~outOfRange[neighbours]]
+        row[pixel] = row[neighbours].mean() if neighbours is not None and len(neighbours) else -273.15
+    for pixel, neighbours in cal.badPixels[mode][subPage]:
+        row[pixel] = row[neighbours].mean() if neighbours is not None and len(neighbours) else -273.15
+
+
+# --------- process pool -----------------------------------------------------
+_worker = {}
+
+
+def _InitWorker(log, output, count, cal, emissivity, reflected_temperature):
+    _worker['records'] = np.memmap(log, dtype='<u2', mode='r', offset=DATA_OFFSET, shape=(count, RECORD_WORDS))
+    _worker['output'] = np.lib.format.open_memmap(output, mode='r+')
+    _worker['cal'] = cal
+    _worker['emissivity'] = emissivity
+    _worker['reflected_temperature'] = reflected_temperature
+
+
+def _ConvertChunk(bounds):
+    start, stop = bounds
+    cal = _worker['cal']
+    records = np.asarray(_worker['records'][start:stop])
+    temperatures = calculate_to(cal, records, _worker['emissivity'], _worker['reflected_temperature'])
+    outOfRange = out_of_range(records[:, 2:])
+    previous = None
+    for k in range(len(temperatures)):
+        complete_row(cal, temperatures[k], previous, records[k, 2 + 832], records[k, 2 + 833], outOfRange[k])
+        previous = temperatures[k]
+    _worker['output'][start:stop] = temperatures
+    _worker['output'].flush()
+    return stop - start
+
+
+def convert(log, output, emissivity=0.95, reflected_temperature=None, interpolate_bad_pixels=True,
+            processes=None, chunk=CHUNK_RECORDS):
+    """Converts the Recorder log into an (subpages, 768) float32 .npy file.
+    Returns the number of subpages converted"""
+    reader = LogReader(log)
+    cal = Calibration(reader.eeprom, interpolate_bad_pixels)
+    reader.close()
+    count = (os.path.getsize(log) - DATA_OFFSET) // (2 * RECORD_WORDS)
+
+    out = np.lib.format.open_memmap(output, mode='w+', dtype=np.float32, shape=(count, 768))
+    del out
+    chunks = [(start, min(start + chunk, count)) for start in range(0, count, chunk)]
+    options = (log, output, count, cal, emissivity, reflected_temperature)
+    with Pool(processes, initializer=_InitWorker, initargs=options) as pool:
+        converted = sum(pool.imap_unordered(_ConvertChunk, chunks))
+
+    # each chunk started without the previous subpage: complete its first rows
+    if count:
+        records = np.memmap(log, dtype='<u2', mode='r', offset=DATA_OFFSET, shape=(count, RECORD_WORDS))
+        out = np.lib.format.open_memmap(output, mode='r+')
+        for start, stop in chunks[1:]:
+            k = start
+            while k < stop and np.isnan(out[k]).any():
+                complete_row(cal, out[k], out[k - 1], records[k, 2 + 832], records[k, 2 + 833],
+                             out_of_range(records[k, 2:]))
+                k += 1
+        out.flush()
+    return converted
+
+
+def check(log, output, frames=CHECK_FRAMES, saturated=CHECK_SATURATED):
+    """Records synthetic subpages with saturated pixels into log through the
+    driver (Simulator, progressive, so that each frame matches the row of its
+    second subpage), converts the log into output and returns the largest
+    difference between driver and converter, first frame excluded"""
+
+    def source():
+        for frame in Simulator.SyntheticFrames():
+            for pixel in saturated:
+                frame[pixel] = 0x7FF0
+            yield frame
+
+    sensor = Sensor(calibration_cache=False, i2c=Simulator.SimulatedI2C(frames=source()))
+    sensor.progressive = True
+    sensor.recorder = Recorder(log, sensor.eeData)
+    driver = []
+    for _ in range(frames):
+        sensor.getFrame()
+        driver.append(np.array(frame_buffers.front(), dtype=np.float32))
+    sensor.recorder.close()
+
+    convert(log, output, sensor.emissivity, sensor.reflected_temperature, sensor.interpolate_bad_pixels, 1)
+    rows = np.load(output)[1::2]
+    return float(np.abs(rows[1:] - np.array(driver[1:])).max())
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Converts a Recorder log into temperatures (.npy)")
+    parser.add_argument("log", help="subpage log written by Recorder.py")
+    parser.add_argument("output", help="output .npy file, (subpages, 768) float32")
+    parser.add_argument("--emissivity", type=float, default=0.95)
+    parser.add_argument("--reflected", type=float, default=None,
+                        help="reflected temperature in degC (default: Ta - %d)" % OPENAIR_TA_SHIFT)
+    parser.add_argument("--no-interpolation", action="store_true", help="bad pixels at -273.15")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--chunk", type=int, default=CHUNK_RECORDS)
+    parser.add_argument("--check", action="store_true",
+                        help="record synthetic subpages with saturated pixels into log, convert them and compare "
+                             "with the driver")
+    args = parser.parse_args()
+
+    if args.check:
+        difference = check(args.log, args.output)
+        print("driver and converter differ by %0.6f degC: %s"
+              % (difference, "ok" if difference <= CHECK_TOLERANCE else "FAILED"))
+        raise SystemExit(difference > CHECK_TOLERANCE)
+
+    stamp = time.monotonic()
+    subpages = convert(args.log, args.output, args.emissivity, args.reflected, not args.no_interpolation,
+                       args.processes, args.chunk)
+    elapsed = time.monotonic() - stamp
+    print("%d subpages in %0.2f s: %0.0f subpages/s" % (subpages, elapsed, subpages / max(elapsed, 1e-9)))
@@ -15,7 +15,7 @@ Implementation Notes
     
 """
 
-from Sensor import sensor_running, frame_lock, frame
+from Sensor import sensor_running, frame_buffers
 from Colors import Color
 from Pages import pages
 
@@ -129,6 +129,9 @@ class Configs():
         # Mode
         self.interpolate_pixels = False
         self.calculate_colors = False
+        self.temporal_filter = data[3]['fields'][4]['value']   # denoise frames: useful at 8-16Hz
+        self.progressive = False               # show each subpage as soon as converted
+        self.auto_roi = False                  # convert mostly around the touched spot
         self.step = False
 #        self.calibration_level = 2
         self.calibration_level = data[1]['fields'][3]['value']
@@ -169,13 +172,17 @@ class Configs():
 class Payload():
     # Global Camera data registers
     """
-        frame:
-            - 32 x 48 temperature (float) from sensor 
+        frame_buffers:
+            - ping-pong pair of 32 x 24 temperature (float) frames from sensor
         pages:
             - array of Pages:
                  - Page is a dictionary of Fields, with rendering commands and configs
         temperatures:
             - list of temperatures (Average, Center, Min, Max, Spot)
+        spot_index:
+            - sensor pixel (0..767) selected on the frame, or None: the sensor converts around it
+        hot_index, cold_index:
+            - sensor pixels of the maximum and minimum temperatures of the last rendered frame
         configs:
             - object with camera's configs
         colors:
@@ -183,22 +190,24 @@ class Payload():
     """
 
         
-    global frame, sensor_running, frame_lock
+    global frame_buffers, sensor_running
     
     def __init__(self):
         
         # registers
-        self.frame = frame
+        self.frame_buffers = frame_buffers
         self.pages = pages
         self.temperatures = {'center': 0.0,
                              'average': 0.0,
                              'max': 0.0,
                              'min': 0.0,
                              'spot': 0.0}
+        self.spot_index = None
+        self.hot_index = 0
+        self.cold_index = 0
         self.colors = Colors()
         self.configs = Configs()
         self.text = ""
         
         # flags
         self.sensor_running = sensor_running
-        self.frame_lock = frame_lock
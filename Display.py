@@ -25,11 +25,22 @@ ERRORS:
 
 """
 
-from machine import Pin, SPI, PWM
+from machine import Pin, SPI, PWM, mem32
+from collections import OrderedDict
 import framebuf
 import time
 import gc
 
+try:
+    from rp2 import DMA
+except ImportError:
+    DMA = None
+
+try:
+    from binascii import crc32
+except ImportError:
+    crc32 = None
+
 # Hardware data
 
 LCD_DC   = const(8)
@@ -42,6 +53,12 @@ LCD_RST  = const(15)
 TP_CS    = const(16)
 TP_IRQ   = const(17)
 
+SPI1_BASE    = const(0x40040000)    # PL022 of SPI(1)
+SSP_DR       = const(0x008)         # data register
+SSP_SR       = const(0x00C)         # status register
+SSP_SR_BSY   = const(0x10)          # busy: frame being shifted out
+DREQ_SPI1_TX = const(18)            # DMA request of SPI(1) transmit FIFO
+
 TOUCH_SAMPLES = const(5)
 CALIBRATION_LEVEL = const(1)
 
@@ -71,20 +88,123 @@ FIELD_BLOCK_SIZE  = const(FIELD_BLOCK_WIDTH * FIELD_BLOCK_HEIGHT)
 ICON_WIDTH = const(16)
 ICON_SIZE = const(ICON_WIDTH * ICON_WIDTH)
 
+ROW_WIDTH = const(DISPLAY_WIDTH - BLOCK_STEP)     # frame rows: display width left of the bar
+
+ASSET_CACHE_SIZE = const(8192)  # RAM budget (bytes) of cached icons and sprites
+
+# ILI9488 initialization: (command, parameters, delay in ms after it)
 
-# Framebuffers
+INIT_SEQUENCE = (
+    (0x21, b'', 0),                                   #Display Inversion ON
+    (0xC2, b'\x33', 0),                               #Power Control 3 (DCA1, DCA0)
+    (0xC5, b'\x00\x1E\x80', 0),                       #VCOM Control 1 (nVM, VCM_REG, VCM_REG_EN)
+    (0xB1, b'\xB0', 0),                               #Frame Rate Control (FRS, DIVA)
+    (0x36, b'\x28', 0),                               #Memory Access Control (MY, MX, MV, ML, BGR, MH)
+    (0xE0, b'\x00\x13\x18\x04\x0F\x06\x3A\x56\x4D\x03\x0A\x06\x30\x3E\x0F', 0),   #PGAMCTRL (VP0..VP63)
+    (0xE1, b'\x00\x13\x18\x01\x11\x06\x38\x34\x4D\x06\x0D\x0B\x31\x37\x0F', 0),   #NGAMCTRL (VN0..VN63)
+    (0x3A, b'\x55', 0),                               #Interface Pixel Format (DPI, DBI)
+    (0x11, b'', 120),                                 #Sleep OUT
+    (0x29, b'', 0),                                   #Display ON
+    (0xB6, b'\x00\x62', 0),                           #Display Function Control (BYPASS.., GS, SS, SM, ISC)
+    (0x36, b'\x28', 0),                               #Memory Access Control (MY, MX, MV, ML, BGR, MH)
+)
+
+
+# Framebuffers (pairs with DMA: one is rendered while the other is sent)
 
 frame_buffer = bytearray(FRAME_BLOCK_SIZE * 2)
 field_buffer = bytearray(FIELD_BLOCK_SIZE * 2)
+frame_spare_buffer = None
+field_spare_buffer = None
+if DMA is not None:
+    frame_spare_buffer = bytearray(FRAME_BLOCK_SIZE * 2)
+    field_spare_buffer = bytearray(FIELD_BLOCK_SIZE * 2)
 
 # classes
 
+class AssetCache:
+    """
+        RGB565 bitmaps loaded from flash, kept in RAM as (bytearray, size) up
+        to budget bytes, evicting the least recently used
+    """
+    
+    def __init__(self, budget=ASSET_CACHE_SIZE):
+        self.budget = budget
+        self.size = 0                               # bytes of cached bitmaps
+        self.assets = OrderedDict()                 # least recently used first
+        self.hits = 0
+        self.misses = 0
+        
+    def get(self, path, w, h):
+        """ Returns the w x h bitmap in file path as a bytearray, from RAM when
+        cached. Bitmaps larger than the budget are loaded but never cached """
+        
+        size = w * h * 2
+        assets = self.assets
+        asset = assets.pop(path, None)
+        if asset is not None:
+            if asset[1] == size:
+                self.hits += 1
+                assets[path] = asset                # now the most recently used
+                return asset[0]
+            self.size -= asset[1]
+        
+        self.misses += 1
+        buffer = self.load(path, size)
+        if size > self.budget:
+            return buffer
+        
+        # evict down to budget, then keep it
+        while self.size + size > self.budget:
+            self.size -= assets.pop(next(iter(assets)))[1]
+        assets[path] = (buffer, size)
+        self.size += size
+        return buffer
+    
+    def load(self, path, size):
+        gc.collect()
+        with open(path, "rb") as f:
+            return bytearray(f.read(size))
+    
+    def clear(self):
+        self.assets = OrderedDict()
+        self.size = 0
+        
+    def statistics(self):
+        """Cache hits, misses (file loads) and RAM used"""
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': self.size}
+
+
 class Display(framebuf.FrameBuffer):
     # ILI9488 LCD/XPT2046 Touch driver
-    def __init__(self, brightness=50):        
+    def __init__(self, brightness=50, asset_budget=ASSET_CACHE_SIZE):        
         
         self.current_buffer = frame_buffer
+        self.frame_buffer = frame_buffer
+        self.field_buffer = field_buffer
         self.icon_buffer = None
+        self.assets = AssetCache(asset_budget)
+        self.buffer_size = (FRAME_BLOCK_WIDTH, FRAME_BLOCK_HEIGHT)
+        
+        # preallocated command buffers (no allocation per SPI transaction)
+        self.cmd_buffer = bytearray(1)
+        self.data_buffer = bytearray(1)
+        self.window_buffer = bytearray(4)
+        self.block = (0, 0, 0, 0)                   # LCD window of the next transfer
+        
+        # block transfer pipeline: DMA where the port offers it, blocking writes otherwise
+        self.transfer_buffer = None                 # buffer being sent (kept alive)
+        
+        # dirty block tracking: crc32 of the blocks known to be on LCD
+        self.block_digests = {}
+        self.sent_bytes = 0
+        self.skipped_bytes = 0
+        self.dma = None
+        if DMA is not None:
+            self.dma = DMA()
+            self.dma_ctrl = self.dma.pack_ctrl(size=0, inc_write=False, treq_sel=DREQ_SPI1_TX)
         
         self.cs = Pin(LCD_CS,Pin.OUT)
         self.rst = Pin(LCD_RST,Pin.OUT)
@@ -129,20 +249,39 @@ class Display(framebuf.FrameBuffer):
 # start of core functions
     
     def write_cmd(self, cmd):
+        self.wait_transfer()
+        self.cmd_buffer[0] = cmd
         self.cs(1)
         self.dc(0)
         self.cs(0)
-        self.spi.write(bytearray([cmd]))
+        self.spi.write(self.cmd_buffer)
         self.cs(1)
 
     def write_data(self, dat):
+        self.wait_transfer()
+        self.data_buffer[0] = dat
         self.cs(1)
         self.dc(1)
         self.cs(0)
-        self.spi.write(bytearray([dat]))
+        self.spi.write(self.data_buffer)
+        self.cs(1)
+
+    def write_command(self, cmd, params=None):
+        """ Sends a command and its parameters in a single CS-framed transaction """
+        
+        self.wait_transfer()
+        self.cmd_buffer[0] = cmd
+        self.cs(1)
+        self.dc(0)
+        self.cs(0)
+        self.spi.write(self.cmd_buffer)
+        if params:
+            self.dc(1)
+            self.spi.write(params)
         self.cs(1)
 
     def read_data(self, num_bytes):
+        self.wait_transfer()
         self.cs(1)
         self.dc(1)
         self.cs(0)
@@ -150,6 +289,55 @@ class Display(framebuf.FrameBuffer):
         self.cs(1)
         return data
     
+    def start_transfer(self, buffer):
+        """ Sends the window set by set_block and Memory Write with buffer
+        as its data; returns while DMA sends the data, if available """
+        
+        self.send_block()
+        self.sent_bytes += len(buffer)
+        if self.dma is None:
+            self.write_command(0x2C, buffer)              #Memory Write
+            return
+        
+        self.cmd_buffer[0] = 0x2C                         #Memory Write
+        self.cs(1)
+        self.dc(0)
+        self.cs(0)
+        self.spi.write(self.cmd_buffer)
+        self.dc(1)
+        self.transfer_buffer = buffer
+        self.dma.config(read=buffer, write=SPI1_BASE + SSP_DR, count=len(buffer), ctrl=self.dma_ctrl, trigger=True)
+
+    def wait_transfer(self):
+        """ Waits for the transfer in progress, if any, to leave the SPI and
+        closes its CS frame """
+        
+        if self.transfer_buffer is None:
+            return
+        while self.dma.active():
+            pass
+        while mem32[SPI1_BASE + SSP_SR] & SSP_SR_BSY:
+            pass
+        self.cs(1)
+        self.transfer_buffer = None
+
+    def invalidate(self, block=None):
+        """ Forgets the digests of the blocks intersecting block, (x, y, x1, y1),
+        or of all blocks: their LCD content is no longer known """
+        
+        if block is None:
+            self.block_digests = {}
+            return
+        x, y, x1, y1 = block
+        for key in [key for key in self.block_digests
+                    if key[0] <= x1 and x <= key[2] and key[1] <= y1 and y <= key[3]]:
+            del self.block_digests[key]
+
+    def transfer_statistics(self):
+        """Bytes sent to LCD and bytes of blocks skipped as already shown"""
+        return {'sent': self.sent_bytes,
+                'skipped': self.skipped_bytes}
+
     def get_ili9488_ID(self):
         """ Check Display ID """
         
@@ -169,61 +357,11 @@ class Display(framebuf.FrameBuffer):
         self.rst(1)
         time.sleep_ms(5)
         
-        self.write_cmd(0x21)   #Display Inversion ON
-        self.write_cmd(0xC2)   #Power Control 3
-        self.write_data(0x33)  #Power Control 3 (DCA1, DCA0)
-        self.write_cmd(0XC5)   #VCOM Control 1
-        self.write_data(0x00)  #VCOM Control 1 (nVM)
-        self.write_data(0x1E)  #VCOM Control 1 (VCM_REG) 
-        self.write_data(0x80)  #VCOM Control 1 (VCM_REG_EN)
-        self.write_cmd(0xB1)   #Frame Rate Control (In Normal Mode/Full Colors)
-        self.write_data(0xB0)  #Frame Rate Control (In Normal Mode/Full Colors) (FRS, DIVA)
-        self.write_cmd(0x36)   #Memory Access Control
-        self.write_data(0x28)  #Memory Access Control (MY, MX, MV, ML, BGR, MH)
-        self.write_cmd(0xE0)   #PGAMCTRL (Positive Gamma Control)
-        self.write_data(0x00)  #PGAMCTRL (Positive Gamma Control, VP0) 
-        self.write_data(0x13)  #PGAMCTRL (Positive Gamma Control, VP1)
-        self.write_data(0x18)  #PGAMCTRL (Positive Gamma Control, VP2)
-        self.write_data(0x04)  #PGAMCTRL (Positive Gamma Control, VP4)
-        self.write_data(0x0F)  #PGAMCTRL (Positive Gamma Control, VP6)
-        self.write_data(0x06)  #PGAMCTRL (Positive Gamma Control, VP13)
-        self.write_data(0x3a)  #PGAMCTRL (Positive Gamma Control, VP20)
-        self.write_data(0x56)  #PGAMCTRL (Positive Gamma Control, VP36, VP27)
-        self.write_data(0x4d)  #PGAMCTRL (Positive Gamma Control, VP43)
-        self.write_data(0x03)  #PGAMCTRL (Positive Gamma Control, VP50)
-        self.write_data(0x0a)  #PGAMCTRL (Positive Gamma Control, VP57)
-        self.write_data(0x06)  #PGAMCTRL (Positive Gamma Control, VP59)
-        self.write_data(0x30)  #PGAMCTRL (Positive Gamma Control, VP61)
-        self.write_data(0x3e)  #PGAMCTRL (Positive Gamma Control, VP62)
-        self.write_data(0x0f)  #PGAMCTRL (Positive Gamma Control, VP63)
-        self.write_cmd(0XE1)   #NGAMCTRL(Negative Gamma Control)
-        self.write_data(0x00)  #NGAMCTRL(Negative Gamma Control, VN0)
-        self.write_data(0x13)  #NGAMCTRL(Negative Gamma Control, VN1)
-        self.write_data(0x18)  #NGAMCTRL(Negative Gamma Control, VN2)
-        self.write_data(0x01)  #NGAMCTRL(Negative Gamma Control, VN4)
-        self.write_data(0x11)  #NGAMCTRL(Negative Gamma Control, VN6)
-        self.write_data(0x06)  #NGAMCTRL(Negative Gamma Control, VN13)
-        self.write_data(0x38)  #NGAMCTRL(Negative Gamma Control, VN20)
-        self.write_data(0x34)  #NGAMCTRL(Negative Gamma Control, VN27, VN36)
-        self.write_data(0x4d)  #NGAMCTRL(Negative Gamma Control, VN43)
-        self.write_data(0x06)  #NGAMCTRL(Negative Gamma Control, VN50)
-        self.write_data(0x0d)  #NGAMCTRL(Negative Gamma Control, VN57)
-        self.write_data(0x0b)  #NGAMCTRL(Negative Gamma Control, VN59)
-        self.write_data(0x31)  #NGAMCTRL(Negative Gamma Control, VN61)
-        self.write_data(0x37)  #NGAMCTRL(Negative Gamma Control, VN62)
-        self.write_data(0x0f)  #NGAMCTRL(Negative Gamma Control, VN63)
-        self.write_cmd(0X3A)   #Interface Pixel Format
-        self.write_data(0x55)  #Interface Pixel Format (DPI, DBI)
-        self.write_cmd(0x11)   #Sleep OUT
-        
-        time.sleep_ms(120)
-        
-        self.write_cmd(0x29)   #Display ON
-        self.write_cmd(0xB6)   #Display Function Control
-        self.write_data(0x00)  #Display Function Control (BYPASS, RCM, RM, DM, PTG, PT)
-        self.write_data(0x62)  #Display Function Control (GS, SS, SM, ISC)
-        self.write_cmd(0x36)   #Memory Access Control
-        self.write_data(0x28)  #Memory Access Control (MY, MX, MV, ML, BGR, MH)
+        self.invalidate()
+        for cmd, params, delay in INIT_SEQUENCE:
+            self.write_command(cmd, params)
+            if delay:
+                time.sleep_ms(delay)
 
     def brightness(self,duty):
         """Sets the LCD brightness (0 to 100)"""
@@ -248,66 +386,118 @@ class Display(framebuf.FrameBuffer):
                 self.show_block()
 
     def set_buffer(self, buffer_type='frame'):
-        """change framebuffer (frame, bar, strip or button)"""
+        """change framebuffer (frame, row, bar, strip or button); row is the
+        frame buffer as full frame width lines"""
 
         if buffer_type == 'frame':
-            self.current_buffer = frame_buffer
+            self.current_buffer = self.frame_buffer
             width, height = FRAME_BLOCK_WIDTH, FRAME_BLOCK_HEIGHT
+        elif buffer_type == 'row':
+            self.current_buffer = self.frame_buffer
+            width, height = ROW_WIDTH, FRAME_BLOCK_SIZE // ROW_WIDTH
         elif buffer_type == 'icon':
             self.current_buffer = self.icon_buffer
             width, height = ICON_WIDTH, ICON_WIDTH
         else:
-            self.current_buffer = field_buffer
+            self.current_buffer = self.field_buffer
             width, height = FIELD_BLOCK_WIDTH, FIELD_BLOCK_HEIGHT
+        self.buffer_size = (width, height)
         super().__init__(self.current_buffer, width, height, framebuf.RGB565)
 
+    def swap_buffer(self):
+        """ While DMA still sends the current frame/field block, renders on its
+        spare buffer from now on, starting as a copy of the block being sent.
+        Blocking transfers keep rendering on the same buffer """
+        
+        if self.dma is None or self.transfer_buffer is None:
+            return
+        if not self.dma.active():
+            self.wait_transfer()
+            return
+        buffer = self.current_buffer
+        if buffer is self.frame_buffer:
+            spare = frame_spare_buffer if buffer is frame_buffer else frame_buffer
+            self.frame_buffer = spare
+        elif buffer is self.field_buffer:
+            spare = field_spare_buffer if buffer is field_buffer else field_buffer
+            self.field_buffer = spare
+        else:
+            return
+        spare[:] = buffer
+        self.current_buffer = spare
+        width, height = self.buffer_size
+        super().__init__(spare, width, height, framebuf.RGB565)
+
     def set_block(self, x, y, dx, dy):
-        """ sets the current display block """
+        """ sets the current display block (sent to LCD with the next transfer,
+        so that a block can be rendered while the previous one is sent) """
         
-        x1 , y1 = x+dx , y+dy
+        self.block = (x, y, x+dx, y+dy)
+
+    def send_block(self):
+        """ sends the current display block window to LCD """
+        
+        self.wait_transfer()
+        self.invalidate(self.block)
+        x, y, x1, y1 = self.block
+        window = self.window_buffer
+        cmd = self.cmd_buffer
+        spi = self.spi
+        
+        # both address sets in one CS frame, DC toggled between command and parameters
+        self.cs(1)
+        self.cs(0)
         
         # Column Address Set (SC,EC)
-        self.write_cmd(0x2A)
-        self.write_data(x>>8)    # Start Column (xH)
-        self.write_data(x&0xff)  # Start Column (xL)
-        self.write_data(x1>>8)    # End Column (x1H)
-        self.write_data(x1&0xff)  # End Column (x1L)
+        cmd[0] = 0x2A
+        window[0], window[1], window[2], window[3] = x>>8, x&0xff, x1>>8, x1&0xff
+        self.dc(0)
+        spi.write(cmd)
+        self.dc(1)
+        spi.write(window)
         
         #Page Address Set (SP,EP)
-        self.write_cmd(0x2B)
-        self.write_data(y>>8)    # Start Page (yH)
-        self.write_data(y&0xff)  # Start Page (yL)
-        self.write_data(y1>>8)    # End Page (y1H)
-        self.write_data(y1&0xff)  # End Page (y1L)
-        
-    def show_block(self):
-        """ Shows the current block on LCD """
-            
-        self.write_cmd(0x2C)                              #Memory Write
-
-        self.cs(1)
+        cmd[0] = 0x2B
+        window[0], window[1], window[2], window[3] = y>>8, y&0xff, y1>>8, y1&0xff
+        self.dc(0)
+        spi.write(cmd)
         self.dc(1)
-        self.cs(0)
-        self.spi.write(self.current_buffer)
-        self.cs(1)        
+        spi.write(window)
+        
+        self.cs(1)
+        
+    def show_block(self, track=True):
+        """ Shows the current block on LCD: starts sending it and swaps
+        frame/field blocks to their spare buffer for the next render.
+        Tracked blocks byte-identical to what LCD shows are skipped;
+        blocks that change every time are cheaper untracked """
+        
+        buffer = self.current_buffer
+        digest = crc32(buffer) if track and crc32 is not None else None
+        if digest is not None and self.block_digests.get(self.block) == digest:
+            self.skipped_bytes += len(buffer)
+            return
+        
+        self.start_transfer(buffer)
+        self.swap_buffer()
+        if digest is not None:
+            self.block_digests[self.block] = digest
+
+    def show_rows(self, x, y, w, h):
+        """ Shows the first h lines of the current buffer, w pixels wide (its
+        width), at x, y on LCD """
+        
+        self.set_block(x, y, w-1, h-1)
+        self.start_transfer(memoryview(self.current_buffer)[:w * h * 2])
+        self.swap_buffer()
 
     def draw_point(self,x,y,color):
         """Draws a point (a colored 4 pixel rectangle) on LCD"""
 
         bytearray_color =  bytearray([color&0xff, color>>8])
 
-        self.write_cmd(0x2A)
-        self.write_data((x-1)>>8)
-        self.write_data((x-1)&0xff)
-        self.write_data(x>>8)
-        self.write_data(x&0xff)
-        
-        self.write_cmd(0x2B)
-        self.write_data((y-1)>>8)
-        self.write_data((y-1)&0xff)
-        self.write_data(y>>8)
-        self.write_data(y&0xff)
-        
+        self.set_block(x-1, y-1, 1, 1)
+        self.send_block()
         self.write_cmd(0x2C)
         
         self.cs(1)
@@ -322,18 +512,8 @@ class Display(framebuf.FrameBuffer):
               
         bytearray_color =  bytearray([color&0xff, color>>8])       
  
-        self.write_cmd(0x2A)
-        self.write_data(x>>8)
-        self.write_data(x&0xff)
-        self.write_data((x+pixel_size_x)>>8)
-        self.write_data((x+pixel_size_x)&0xff)
-        
-        self.write_cmd(0x2B)
-        self.write_data(y>>8)
-        self.write_data(y&0xff)
-        self.write_data((y+pixel_size_y)>>8)
-        self.write_data((y+pixel_size_y)&0xff)
-        
+        self.set_block(x, y, pixel_size_x, pixel_size_y)
+        self.send_block()
         self.write_cmd(0x2C)
         
         self.cs(1)
@@ -360,9 +540,7 @@ class Display(framebuf.FrameBuffer):
             return
         else:
             self.set_buffer('sprite')
-            gc.collect()
-            with open(path, "rb") as f:
-                self.current_buffer = f.read(buf_size)
+            self.current_buffer = self.assets.get(path, w, h)
 
     def load_icon(self, path):
         """Load icon image.
@@ -371,11 +549,9 @@ class Display(framebuf.FrameBuffer):
             path (string): Image file path (bin file with RGB565 pyxels).
 
         Notes:
-            icon is a ICON_WIDTH x ICON_WIDTH sprite
+            icon is a ICON_WIDTH x ICON_WIDTH sprite, cached in RAM
         """
-        gc.collect()
-        with open(path, "rb") as f:
-            self.icon_buffer = bytearray(f.read(ICON_SIZE * 2))
+        self.icon_buffer = self.assets.get(path, ICON_WIDTH, ICON_WIDTH)
             
     def show_icon(self, filename, i, j):
         """Show icon at position i,j
@@ -426,6 +602,7 @@ class Display(framebuf.FrameBuffer):
         if self.irq.value() == 0 and not self.touch_active:  # Trigger only if no active touch
 
             # Switch SPI settings for the touch sensor
+            self.wait_transfer()
             original_spi = self.spi
             self.spi = SPI(1, 5_000_000, sck=Pin(LCD_SCK), mosi=Pin(LCD_MOSI), miso=Pin(LCD_MISO))
             self.tp_cs(0)
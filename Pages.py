@@ -140,12 +140,12 @@ pages = [
                  'list': ['0', '1', '2', '3', '4', '5', '6', '7'],                 
                  'text': "Calibration Level",
                  'active': True},
-                {'type': 'null',                 # Field 4
-                 'name': "",
+                {'type': 'message',              # Field 4
+                 'name': "Sensor",                        # refresh rate and I2C clock set by the rate controller
                  'highlighted': False,
-                 'value': None,
-                 'text': "",
-                 'active': False},      
+                 'value': "",
+                 'text': "Sensor refresh rate and I2C clock",
+                 'active': True},      
                 ]
         },
         {'title': "ThermalCam",                       # Page 2
@@ -240,12 +240,12 @@ pages = [
                  'value': False,
                  'text': "Power sleep mode",
                  'active': True},
-                {'type': 'null',             # Field 4
-                 'name': "",
+                {'type': 'radio',            # Field 4
+                 'name': "Denoise",          # temporal filter of sensor frames (adds latency)
                  'highlighted': False,
-                 'value': None,
-                 'text': "",
-                 'active': False},           
+                 'value': False,
+                 'text': "Denoise frames",
+                 'active': True},           
                 ]
         },
         {'title': "ThermalCam",                       # Page 4 - Show Cntr, Avg, Max, Min temps from frame
@@ -0,0 +1,159 @@
+"""
+Thermal camera
+================================================================================
+
+Raw subpage recorder:
+
+
+* Author(s): Paulo Teixeira
+
+
+Implementation Notes
+--------------------
+
+    Recorder keeps the raw subpages the sensor reads, so that temperatures can
+    be recomputed later with other emissivity, reflected temperature or bad
+    pixel settings (see LogReader, Simulator.SimulatedI2C and Converter.py).
+
+    Log layout, little-endian 16-bit words:
+
+        header      LOG_HEADER: magic, version, record words, EEPROM words
+        EEPROM      832 words (Sensor.eeData)
+        records     ticks_ms (2 words, low first), mlx90640Frame (834 words:
+                    RAM, control register, subpage)
+
+    Records are packed back to back into a two-page word buffer and written
+    out one full page at a time, so the file system only sees page-sized
+    writes. At 64Hz a log grows by about 107 kB/s.
+
+    Usage:
+
+        sensor.recorder = Recorder("session.mlx", sensor.eeData)
+        ...
+        sensor.recorder.close()
+
+"""
+
+import struct
+from array import array
+
+LOG_MAGIC = b"MLXR"
+LOG_VERSION = 1
+LOG_HEADER = "<4sHHH"                       # magic, version, record words, EEPROM words
+EEPROM_WORDS = 832
+FRAME_WORDS = 834                           # mlx90640Frame: RAM, control register, subpage
+RECORD_WORDS = 2 + FRAME_WORDS              # ticks_ms, frame
+PAGE_SIZE = 4096                            # bytes per write: SD/flash page or sector
+
+
+class Recorder:
+    """
+        Appends raw subpages to a binary log through a page-sized buffer
+    """
+
+    def __init__(self, filename, eeprom, page_size=PAGE_SIZE):
+        self.filename = filename
+        self.page = page_size // 2          # page in words
+        self.buffer = array('H', [0] * (2 * self.page))
+        self.view = memoryview(self.buffer)
+        self.fill = 0                       # buffered words
+        self.records = 0
+        self.written = 0                    # bytes written, header included
+        if RECORD_WORDS > self.page:
+            raise ValueError("Page smaller than a record")
+        self.file = open(filename, "wb")
+        self.written += self.file.write(struct.pack(LOG_HEADER, LOG_MAGIC, LOG_VERSION, RECORD_WORDS, EEPROM_WORDS))
+        self.written += self.file.write(array('H', eeprom))
+
+    def record(self, frameData, ticks):
+        """Buffers one subpage (834 words) read at ticks_ms; writes a page when
+        one is full"""
+        fill = self.fill
+        buffer = self.buffer
+        buffer[fill] = ticks & 0xFFFF
+        buffer[fill + 1] = (ticks >> 16) & 0xFFFF
+        self.view[fill + 2:fill + RECORD_WORDS] = memoryview(frameData)[:FRAME_WORDS]
+        fill += RECORD_WORDS
+        self.records += 1
+
+        page = self.page
+        if fill >= page:
+            self.written += self.file.write(self.view[:page])
+            fill -= page
+            self.view[:fill] = self.view[page:page + fill]
+        self.fill = fill
+
+    def flush(self):
+        """Writes the buffered words, even a partial page"""
+        if self.fill:
+            self.written += self.file.write(self.view[:self.fill])
+            self.fill = 0
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class LogReader:
+    """
+        Reads a Recorder log: eeprom holds the EEPROM image, iterating yields
+        (ticks, frame) with frame a reused 834-word array. A truncated last
+        record is ignored
+    """
+
+    def __init__(self, filename):
+        self.file = open(filename, "rb")
+        header = struct.unpack(LOG_HEADER, self.file.read(struct.calcsize(LOG_HEADER)))
+        if header[0] != LOG_MAGIC or header[1] != LOG_VERSION:
+            raise ValueError("Not a subpage log")
+        if header[2] != RECORD_WORDS or header[3] != EEPROM_WORDS:
+            raise ValueError("Unsupported record layout")
+        self.eeprom = array('H', [0] * EEPROM_WORDS)
+        self.file.readinto(self.eeprom)
+        self.record = array('H', [0] * RECORD_WORDS)
+        self.frame = memoryview(self.record)[2:]
+
+    def __iter__(self):
+        record = self.record
+        while self.file.readinto(record) == 2 * RECORD_WORDS:
+            yield record[0] | (record[1] << 16), self.frame
+
+    def frames(self):
+        """Frames only, e.g. for Simulator.SimulatedI2C(reader.eeprom, reader.frames())"""
+        for _, frame in self:
+            yield frame
+
+    def close(self):
+        self.file.close()
+
+
+if __name__ == '__main__':
+
+    """ Records subpages from the sensor and reads them back"""
+
+    import time
+    from Sensor import Sensor, RefreshRate
+
+    FILENAME = "session.mlx"
+    FRAMES = 64
+    RATE = RefreshRate.REFRESH_16_HZ
+
+    sensor = Sensor()
+    sensor.refresh_rate = RATE
+    recorder = Recorder(FILENAME, sensor.eeData)
+    sensor.recorder = recorder
+
+    stamp = time.ticks_ms()
+    for _ in range(FRAMES):
+        sensor.getFrame()
+    recorder.close()
+    sensor.recorder = None
+    elapsed = time.ticks_diff(time.ticks_ms(), stamp)
+    print("%d subpages, %d bytes in %d ms: %0.1f kB/s"
+          % (recorder.records, recorder.written, elapsed, recorder.written / elapsed))
+
+    reader = LogReader(FILENAME)
+    count = sum(1 for _ in reader)
+    reader.close()
+    print("Read back %d subpages" % count)
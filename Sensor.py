@@ -23,10 +23,14 @@ ERRORS:
 
 """
 
-import struct
 import math
+import struct
 import time
-from machine import I2C, Pin
+from array import array
+try:
+    from machine import I2C, Pin
+except ImportError:                         # off-target: pass a bus, e.g. Simulator.SimulatedI2C
+    I2C = Pin = None
 import gc
 
 __version__ = "0.0.0-auto.0"
@@ -34,53 +38,331 @@ __version__ = "0.0.0-auto.0"
 # We match the melexis library naming, and don't want to change
 
 # Hardware data
-I2C_READ_LEN = const(2048)
+I2C_READ_LEN = const(2048)                  # maximum words per I2C read
 SCALEALPHA = const(0.000001)
 MLX90640_DEVICEID1 = const(0x2407)
 OPENAIR_TA_SHIFT = const(8)
 I2C_SDA = const(6)
 I2C_SCL = const(7)
 DEVICE_ADDRESS = const(0x33)
+I2C_FREQUENCY = const(400000)
 FRAME_SIZE = const(768)
+SUBPAGE_PERIOD_MS = const(2000)             # subpage period at 0.5Hz, halved for each RefreshRate step
+WAIT_SLEEP_FRACTION = const(7)              # sleep 7/8 of the subpage period before polling
+POLL_INTERVAL_MS = const(1)                 # minimum sleep between status polls
+CALIBRATION_CACHE = "mlx90640_%04x%04x%04x.cal"   # per-sensor calibration cache file
+CACHE_MAGIC = b"MLXC"
+CACHE_VERSION = const(1)
+CACHE_HEADER = "<4sHHHH"                    # magic, version, serial number words
+ROOT_TABLE_SIZE = const(256)                # fast-math fourth-root table intervals
+ROOT_TABLE_MIN = const(-40.0)               # fast-math range in degC, exact roots outside
+ROOT_TABLE_MAX = const(400.0)
+STAGE_WAIT = const(0)                       # StageTimer stages
+STAGE_READ = const(1)
+STAGE_CONTEXT = const(2)
+STAGE_TO = const(3)
+STAGE_PUBLISH = const(4)
+STAGE_GC = const(5)
+STAGE_FILTER = const(6)
+STAGES = const(7)
+TIMING_SAMPLES = const(64)                  # ring buffer length per stage
+INFINITY = float('inf')
+INTEGRITY_SUBPAGE = const(0)                # integrity failures: subpage changed during the read
+INTEGRITY_INVALID = const(1)                # PTAT, Vdd or gain word invalid (bus idle level)
+INTEGRITY_STUCK = const(2)                  # PTAT and Vdd unchanged for STUCK_SUBPAGES subpages
+INTEGRITY_RANGE = const(3)                  # more than RANGE_PIXELS raw pixel words near the ADC rails
+INTEGRITY_CHECKS = const(4)
+INTEGRITY_RETRIES = const(2)                # targeted re-reads of a failed subpage
+STUCK_SUBPAGES = const(8)
+RAW_LIMIT = const(0x7F00)                   # raw pixel words in (RAW_LIMIT, 0x10000 - RAW_LIMIT) are invalid
+RANGE_PIXELS = const(32)                    # out-of-range pixels patched per subpage before it is re-read
+FILTER_ALPHA = const(0.25)                  # temporal filter gain of a still pixel
+FILTER_MOTION = const(1.5)                  # degC step taken as motion: filter gain 1
+
+class FrameStatistics:
+    """
+        Statistics of one temperature frame: filled by the sensor while it
+        converts the pixels, so readers do not rescan the frame
+    """
+
+    def __init__(self):
+        self.minimum = 0.0
+        self.maximum = 0.0
+        self.argmin = 0                             # coldest pixel
+        self.argmax = 0                             # hottest pixel
+        self.total = 0.0
+        self.centre = 0.0
+
+    def average(self):
+        return self.total / FRAME_SIZE
+
+    def copy(self, other):
+        self.minimum = other.minimum
+        self.maximum = other.maximum
+        self.argmin = other.argmin
+        self.argmax = other.argmax
+        self.total = other.total
+        self.centre = other.centre
+
+    def scan(self, frame):
+        """ Computes the statistics from frame, for frames not built by the sensor """
+        minimum = maximum = frame[0]
+        argmin = argmax = 0
+        total = 0.0
+        for index, value in enumerate(frame):
+            total += value
+            if value < minimum:
+                minimum = value
+                argmin = index
+            if value > maximum:
+                maximum = value
+                argmax = index
+        self.minimum, self.maximum = minimum, maximum
+        self.argmin, self.argmax = argmin, argmax
+        self.total = total
+        self.centre = (frame[383] + frame[384]) / 2
+
+
+class FrameBuffers:
+    """
+        Ping-pong pair of temperature frames shared by the sensor and GUI cores.
+
+        The sensor converts into the back buffer and publishes it with a single
+        index swap; the GUI reads the front buffer without per-pixel locking.
+        While the GUI holds the front buffer (acquire/release) the sensor will
+        not start overwriting it.
+    """
+
+    def __init__(self, size):
+        self.buffers = (array('f', [0] * size), array('f', [0] * size))
+        self.statistics = (FrameStatistics(), FrameStatistics())
+        self.tags = array('b', [-1, -1])          # -1: full frame, else mode << 1 | subpage (progressive)
+        self.sequences = array('L', [0, 0])         # sequence number of each buffer
+        self.front_index = 0
+        self.sequence = 0                           # number of published frames
+        self.reading = -1                           # buffer index held by the reader
+
+    def front(self):
+        """ Last published frame """
+        return self.buffers[self.front_index]
+
+    def back(self):
+        """ Frame to be written by the sensor (waits while the reader holds it) """
+        index = self.front_index ^ 1
+        while self.reading == index:
+            time.sleep_ms(1)
+        return self.buffers[index]
+
+    def publish(self, statistics=None, tag=-1):
+        """ Makes the back buffer the new front buffer, with its statistics
+        (computed here if not given) and tag: -1 for a full frame, or
+        mode << 1 | subpage when only that subpage changed (progressive) """
+        back = self.front_index ^ 1
+        if statistics is None:
+            self.statistics[back].scan(self.buffers[back])
+        else:
+            self.statistics[back].copy(statistics)
+        self.tags[back] = tag
+        self.sequences[back] = self.sequence + 1
+        self.front_index = back
+        self.sequence += 1
+
+    def acquire(self):
+        """ Holds and returns the front buffer until release() """
+        while True:
+            index = self.front_index
+            self.reading = index
+            # a publish may have happened before the hold was visible
+            if index == self.front_index:
+                return self.buffers[index]
+
+    def release(self):
+        self.reading = -1
+
+    def statistics_of(self, frame):
+        """ FrameStatistics published with frame (one of the buffers) """
+        return self.statistics[0 if frame is self.buffers[0] else 1]
+
+    def tag_of(self, frame):
+        """ Tag published with frame: -1, or mode << 1 | subpage """
+        return self.tags[0 if frame is self.buffers[0] else 1]
+
+    def sequence_of(self, frame):
+        return self.sequences[0 if frame is self.buffers[0] else 1]
+
 
 # Buffers
-global frame
-frame = [0] * FRAME_SIZE
-mlx90640Frame = [0] * 834                   # Move to GetFrame and use gc.collect() after usage
+frame_buffers = FrameBuffers(FRAME_SIZE)
+mlx90640Frame = array('H', [0] * 834)      # raw RAM words + control register + subpage
 
 # Flags
-global frame_lock, sensor_running
-frame_lock = False
+global sensor_running
 sensor_running = True
 
-class Lock:
-    def __init__(self):
-        self._locked = frame_lock
 
-    def acquire(self, timeout=0):
-        """
-            Tries to acquire the lock in the specified time).
+class StageTimer:
+    """
+        Per-stage timing of the sensor loop, in microseconds, kept in a
+        fixed-size ring buffer per stage. start() sets the reference point,
+        mark(stage) charges the time since the previous mark to stage.
+    """
+
+    names = ('wait', 'read', 'context', 'to', 'publish', 'gc', 'filter')
+
+    def __init__(self, samples=TIMING_SAMPLES):
+        self.samples = samples
+        self.times = array('L', [0] * (STAGES * samples))
+        self.counts = array('L', [0] * STAGES)
+        self._stamp = time.ticks_us()
+
+    def start(self):
+        self._stamp = time.ticks_us()
+
+    def mark(self, stage):
+        now = time.ticks_us()
+        count = self.counts[stage]
+        self.times[stage * self.samples + count % self.samples] = time.ticks_diff(now, self._stamp)
+        self.counts[stage] = count + 1
+        self._stamp = now
+
+    def statistics(self, stage):
+        """(min, mean, p95) in us over the samples held for stage, None if empty"""
+        held = min(self.counts[stage], self.samples)
+        if not held:
+            return None
+        first = stage * self.samples
+        samples = sorted(self.times[first:first + held])
+        return samples[0], sum(samples) / held, samples[(held * 95 - 1) // 100]
+
+    def report(self):
+        """{stage name: (min, mean, p95)} of the stages with samples"""
+        report = {}
+        for stage, name in enumerate(self.names):
+            statistics = self.statistics(stage)
+            if statistics is not None:
+                report[name] = statistics
+        return report
+
+    def reset(self):
+        for stage in range(STAGES):
+            self.counts[stage] = 0
+
+
+class TemporalFilter:
+    """
+        Per-pixel motion-adaptive exponential moving average, applied in place
+        to each converted frame (Sensor.temporal_filter).
+
+        A still pixel is averaged with gain alpha, which cuts the noise variance
+        by alpha / (2 - alpha): 1/7 for 0.25, bringing 16Hz noise close to 2Hz
+        noise while it stays well below motion. The gain rises linearly with
+        the step, to 1 at motion degC, so moving edges follow without lag.
+    """
+
+    def __init__(self, alpha=FILTER_ALPHA, motion=FILTER_MOTION, size=FRAME_SIZE):
+        self.alpha = alpha
+        self.slope = (1 - alpha) / motion
+        self.estimate = array('f', [0] * size)
+        self.primed = False
+
+    def reset(self):
+        """Restarts from the next frame, e.g. after a change of scene or rate"""
+        self.primed = False
+
+    def apply(self, frame, indices=None, statistics=None):
+        """Filters frame in place: all pixels, or only those in indices. With
+        statistics (full frame only), fills them from the filtered values"""
+        estimate = self.estimate
+        if not self.primed:
+            for p in range(len(estimate)):
+                estimate[p] = frame[p]
+            self.primed = True
+            if statistics is not None:
+                statistics.scan(frame)
+            return
+
+        alpha = self.alpha
+        slope = self.slope
+        if indices is not None:
+            for p in indices:
+                value = estimate[p]
+                delta = frame[p] - value
+                gain = alpha + slope * abs(delta)
+                if gain < 1:
+                    value += gain * delta
+                    estimate[p] = value
+                    frame[p] = value
+                else:
+                    estimate[p] = frame[p]
+            return
+
+        low = INFINITY
+        high = -INFINITY
+        lowIndex = highIndex = 0
+        total = 0.0
+        for p in range(len(estimate)):
+            value = estimate[p]
+            delta = frame[p] - value
+            gain = alpha + slope * abs(delta)
+            if gain < 1:
+                value += gain * delta
+                frame[p] = value
+            else:
+                value = frame[p]
+            estimate[p] = value
+            total += value
+            if value < low:
+                low = value
+                lowIndex = p
+            if value > high:
+                high = value
+                highIndex = p
+        if statistics is not None:
+            statistics.minimum, statistics.argmin = low, lowIndex
+            statistics.maximum, statistics.argmax = high, highIndex
+            statistics.total = total
+            statistics.centre = (frame[383] + frame[384]) / 2
+
+
+class FrameRecord:
+    """
+        Frame record yielded by Sensor.frames(). The record and the buffer it
+        references are reused: read them before asking for the next frame.
+    """
 
-                :param timeout: Maximum time (in seconds) to try to get the lock.
-                        If timeout=0, tries to get immediately.
-                :return: True if lock acquired.
-        """
-        start_time = time.time()
-        
-        while True:
-            if not self._locked:
-                self._locked = True
-                return True
-            if timeout > 0 and (time.time() - start_time) >= timeout:
-                return False
-            # wait to avoid excessive CPU use
-            time.sleep(0.01)  # 10 ms
+    def __init__(self):
+        self.sequence = 0                           # published frame number (monotonic)
+        self.ticks = 0                              # ticks_ms when the last subpage was ready
+        self.subpages = 0                           # bit n set: subpage n converted (0b11: complete frame)
+        self.ta = 0.0                               # ambient temperature
+        self.vdd = 0.0                              # supply voltage
+        self.buffer = None                          # published temperature frame
+        self.context = None                         # FrameContext of the last subpage
+        self.roi = False                            # True: only the regions of interest were converted
+        self.dropped = 0                            # subpages dropped so far (missed or failed)
+        self.retries = 0                            # RAM reads retried so far
+
+
+class FrameContext:
+    """
+        Per-subpage terms that only depend on Ta, Vdd and the compensation
+        pixels: computed once by Sensor._UpdateContext, reused by _CalculateTo
+        and attached to the FrameRecord.
+    """
 
-    def release(self):
-        """
-            Liberate lock.
-        """
-        self._locked = False
+    def __init__(self):
+        self.subpage = 0
+        self.mode = 0                               # 0: interleaved, 1: chess
+        self.vdd = 0.0
+        self.ta = 0.0
+        self.tr = 0.0                               # reflected temperature
+        self.emissivity = 1.0
+        self.taTr = 0.0
+        self.gain = 0.0
+        self.irDataCP = [0.0, 0.0]
+        self.alphaCorrR = [0.0, 0.0, 0.0, 0.0]
+        self.dTa = 0.0                              # ta - 25
+        self.dVdd = 0.0                             # vdd - 3.3
 
 
 class RefreshRate:  # pylint: disable=too-few-public-methods
@@ -124,28 +406,108 @@ class Sensor:  # pylint: disable=too-many-instance-attributes
     ilChessC = [0] * 3
     brokenPixels = []
     outlierPixels = []
+    badPixelMap = bytearray(96)                 # 768-bit map of broken and outlier pixels
     cpKta = 0
     cpKv = 0
-    
-    eeData = [0] * 832
-    
-    inbuf = memoryview(bytearray(I2C_READ_LEN*2))
 
-    def __init__(self):
-        self._frame_lock = Lock()
-        self.timeout = 1
+    # Compiled calibration: per-pixel terms that only depend on EEPROM data
+    ktaTable = array('f', [0] * 768)
+    kvTable = array('f', [0] * 768)
+    alphaTable = array('f', [0] * 768)
+    ilChessTable = array('f', [0] * 768)
+    ilPattern = array('b', [0] * 768)
+    chessPattern = array('b', [0] * 768)
+    conversionPattern = array('b', [0] * 768)
+    subPagePixels = ((array('H'), array('H')),     # interleaved mode: good pixels per subpage
+                     (array('H'), array('H')))     # chess mode: good pixels per subpage
+    subPageBadPixels = (([], []), ([], []))        # (pixel, neighbours) of bad pixels per mode/subpage
+    
+    eeData = array('H', [0] * 832)
+
+    # Fast-math fourth root table (see _BuildRootTable)
+    rootTable = None
+    rootBase = 0.0
+    rootScale = 0.0
+    rootLimit = 0.0
+
+    # Calibration cache layout (see _SaveCalibration)
+    _cacheIntegers = ('kVdd', 'vdd25', 'vPTAT25', 'gainEE', 'resolutionEE', 'calibrationModeEE')
+    _cacheFloats = ('KvPTAT', 'KtPTAT', 'alphaPTAT', 'tgc', 'KsTa', 'cpKta', 'cpKv')
+    _cacheLists = ('ksTo', 'ct', 'cpAlpha', 'cpOffset', 'ilChessC')
+    _cacheTables = (('eeData', 2), ('offset', 4), ('ktaTable', 4), ('kvTable', 4),     # (name, item size)
+                    ('alphaTable', 4), ('ilChessTable', 4), ('ilPattern', 1), ('chessPattern', 1),
+                    ('conversionPattern', 1), ('badPixelMap', 1))
+
+    def __init__(self, calibration_cache=True, i2c=None):
         self.device_address = DEVICE_ADDRESS
-        self.i2c_device = I2C(1, scl=Pin(I2C_SCL, Pin.OUT), sda=Pin(I2C_SDA, Pin.OUT), freq=400000)
-        self._I2CReadWords(0x2400, self.eeData)
-        self._ExtractParameters()
+        self.interpolate_bad_pixels = True          # False: bad pixels are set to -273.15
+        self._fastMath = False
+        # preallocated I2C buffers
+        self._statusRegister = array('H', [0])
+        self._controlRegister = array('H', [0])
+        self._checkRegister = array('H', [0])
+        self._writeBuffer = bytearray(4)
+        self._view = None
+        self._viewSource = None
+        self._viewEnd = 0
+        # data-ready wait
+        self.data_ready_pin = None
+        self._dataReadyFlag = False
+        self._lastDataReady = None
+        self.polls = 0
+        self.wait_time = 0
+        self.sleep_time = 0
+        # frame loop
+        self.missed_subpages = 0
+        self.failed_subpages = 0
+        self.integrity_failures = array('L', [0] * INTEGRITY_CHECKS)
+        self.patched_pixels = 0                     # out-of-range pixels patched like bad pixels
+        self._rangePixels = ([], [])                # out-of-range pixels per subpage, filled after both
+        self._lastPtat = -1
+        self._lastVdd = -1
+        self._stuckCount = 0
+        self.retries = 0
+        self._lastSubPage = -1
+        self.rate_controller = None
+        self.recorder = None                        # Recorder.Recorder: logs raw subpages
+        self.temporal_filter = None                 # TemporalFilter: denoises frames before publishing
+        self.progressive = False                    # True: publish each subpage as soon as converted
+        self.timing = StageTimer()
+        # regions of interest (see add_region)
+        self.regions = []                           # (x, y, width, height) in sensor pixels
+        self.roi_grid = 0                           # background grid step in ROI frames, 0: none
+        self.full_refresh_frames = 8                # ROI mode: a full frame every N frames
+        self.roiPixels = None                       # [mode][subpage] pixels of ROI frames, None: ROI off
+        self.roiBadPixels = None
+        self.roi_frame = False
+        self._roiCount = 0
+        # statistics: of the last frame, and of the last conversion of each subpage
+        self.statistics = FrameStatistics()
+        self._subPageStatistics = ([INFINITY, 0, -INFINITY, 0, 0.0],     # min, argmin, max, argmax, sum
+                                   [INFINITY, 0, -INFINITY, 0, 0.0])
+        self.emissivity = 0.95
+        self.reflected_temperature = None           # None: open-air shift below Ta
+        self.context = FrameContext()
+        self.i2c_frequency = I2C_FREQUENCY
+        self._ownBus = i2c is None                  # False: i2c passed in, e.g. a simulated device
+        if self._ownBus:
+            i2c = I2C(1, scl=Pin(I2C_SCL, Pin.OUT), sda=Pin(I2C_SDA, Pin.OUT), freq=I2C_FREQUENCY)
+        self.i2c_device = i2c
+        serialNumber = self.serial_number
+        if not (calibration_cache and self._LoadCalibration(serialNumber)):
+            self._I2CReadWords(0x2400, self.eeData)
+            self._ExtractParameters()
+            if calibration_cache:
+                self._SaveCalibration(serialNumber)
+        self._refreshRate = self.refresh_rate
         print("MLX addr detected on I2C")
-        print("Sensor ID:", [hex(i) for i in self.serial_number])
+        print("Sensor ID:", [hex(i) for i in serialNumber])
         gc.collect()     
 
     @property
     def serial_number(self):
         """3-item tuple of hex values that are unique to each MLX90640"""
-        serialWords = [0, 0, 0]
+        serialWords = array('H', [0, 0, 0])
         self._I2CReadWords(MLX90640_DEVICEID1, serialWords)
         return serialWords
 
@@ -154,43 +516,271 @@ class Sensor:  # pylint: disable=too-many-instance-attributes
         """How fast the MLX90640 will spit out data. Start at lowest speed in
         RefreshRate and then slowly increase I2C clock rate and rate until you
         max out. The sensor does not like it if the I2C host cannot 'keep up'!"""
-        controlRegister = [0]
+        controlRegister = self._controlRegister
         self._I2CReadWords(0x800D, controlRegister)
         return (controlRegister[0] >> 7) & 0x07
 
     @refresh_rate.setter
     def refresh_rate(self, rate):
-        controlRegister = [0]
+        controlRegister = self._controlRegister
         value = (rate & 0x7) << 7
         self._I2CReadWords(0x800D, controlRegister)
         value |= controlRegister[0] & 0xFC7F
         self._I2CWriteWord(0x800D, value)
+        self._refreshRate = rate & 0x7
+        self._lastDataReady = None
 
-    def getFrame(self, framebuf=frame):
+    @property
+    def fast_math(self):
+        """Computes the To fourth roots from a lookup table refined by one Newton
+        step instead of two square roots. Maximum error against the exact path
+        is below 0.001 degC between ROOT_TABLE_MIN and ROOT_TABLE_MAX; outside
+        that range the exact path is used. Off by default: enable it only where
+        BENCHMARK_FAST_MATH (see __main__) measures it faster on the target"""
+        return self._fastMath
+
+    @fast_math.setter
+    def fast_math(self, enabled):
+        if enabled and self.rootTable is None:
+            self._BuildRootTable()
+        self._fastMath = bool(enabled)
+
+    def add_region(self, x, y, width, height):
+        """Registers a region of interest, in sensor pixels (x: 0..31, y: 0..23).
+        While any is registered only the regions, plus a background grid of
+        every roi_grid-th pixel, are converted; the other pixels keep their
+        last values and a full frame is converted every full_refresh_frames"""
+        self.regions.append((x, y, width, height))
+        self._CompileRegions()
+
+    def clear_regions(self):
+        """Back to full-frame conversion"""
+        self.regions = []
+        self._CompileRegions()
+
+    def set_roi_grid(self, step):
+        """Background grid of ROI frames: every step-th pixel in x and y, 0: none"""
+        self.roi_grid = step
+        self._CompileRegions()
+
+    def set_i2c_frequency(self, frequency):
+        """Changes the I2C clock (the MLX90640 supports up to 1MHz). A bus passed
+        to the constructor is left alone, only the frequency is recorded"""
+        if self._ownBus:
+            self.i2c_device = I2C(1, scl=Pin(I2C_SCL, Pin.OUT), sda=Pin(I2C_SDA, Pin.OUT), freq=frequency)
+        self.i2c_frequency = frequency
+
+    def set_data_ready_pin(self, pin):
+        """Optional GPIO hook: a Pin whose rising edge signals a new subpage.
+        Status register polls are then only done after the edge"""
+        self.data_ready_pin = pin
+        self._dataReadyFlag = False
+        if pin is not None:
+            pin.irq(trigger=Pin.IRQ_RISING, handler=self._DataReadyHandler)
+
+    def _DataReadyHandler(self, pin):
+        self._dataReadyFlag = True
+
+    def wait_statistics(self):
+        """Status register polls and time (ms) spent waiting for data, of which slept"""
+        return {'polls': self.polls,
+                'wait': self.wait_time,
+                'sleep': self.sleep_time}
+
+    def integrity_statistics(self):
+        """Subpages failing each integrity check (re-reads included), subpages
+        dropped after the targeted re-reads, and out-of-range (eg. saturated)
+        pixels patched from their neighbours"""
+        failures = self.integrity_failures
+        return {'subpage': failures[INTEGRITY_SUBPAGE],
+                'invalid': failures[INTEGRITY_INVALID],
+                'stuck': failures[INTEGRITY_STUCK],
+                'range': failures[INTEGRITY_RANGE],
+                'dropped': self.failed_subpages,
+                'patched': self.patched_pixels}
+
+    def getFrame(self, framebuf=None):
         """Request both 'halves' of a frame from the sensor, merge them
         and calculate the temperature in degrees C for each of 32x24 pixels. Placed
-        into framebuffer, the 768-element array passed in"""
+        into framebuffer, the 768-element array passed in, or, by default, into
+        the back buffer of frame_buffers, which is then published; in
+        progressive mode each subpage is published on its own, tagged.
+        Returns the converted subpages as bit flags (0b11 for a complete frame)"""
                 
-        emissivity = 0.95
-        tr = 23.15
+        context = self.context
+        timing = self.timing
+        subpages = 0
+        roi = False
+        if self.roiPixels is not None:
+            roi = self._roiCount % self.full_refresh_frames != 0
+            self._roiCount += 1
+        self.roi_frame = roi
+        publish = framebuf is None
+        progressive = publish and self.progressive
+        if publish:
+            framebuf = frame_buffers.back()
+            if roi or progressive:
+                # pixels not converted now keep their last published values
+                framebuf[:] = frame_buffers.front()
         
-        for _ in range(2):
+        for half in range(2):
             status = self._GetFrameData(mlx90640Frame)
             if status < 0:
                 raise RuntimeError("Frame data error")
-            # For a MLX90640 in the open air the shift is -8 degC.
-            tr = self._GetTa(mlx90640Frame) - OPENAIR_TA_SHIFT
-            self._CalculateTo(mlx90640Frame, emissivity, tr, framebuf)            
+            self._UpdateContext(mlx90640Frame, context)
+            timing.mark(STAGE_CONTEXT)
+            outOfRange = self._CalculateTo(mlx90640Frame, context, framebuf, roi)
+            if outOfRange > RANGE_PIXELS:
+                # too many raw words out of range: read this subpage again, once.
+                # ValueError: a slower refresh rate would not help
+                self.integrity_failures[INTEGRITY_RANGE] += 1
+                if self._RereadSubPage(mlx90640Frame) != status:
+                    raise ValueError("Subpage lost")
+                self._UpdateContext(mlx90640Frame, context)
+                outOfRange = self._CalculateTo(mlx90640Frame, context, framebuf, roi)
+                if outOfRange > RANGE_PIXELS:
+                    self.integrity_failures[INTEGRITY_RANGE] += 1
+                    raise ValueError("Raw data out of range")
+            # a few out-of-range pixels (eg. saturated by a hot object) were patched
+            self.patched_pixels += outOfRange
+            timing.mark(STAGE_TO)
+            if self.recorder is not None:
+                self.recorder.record(mlx90640Frame, self._lastDataReady)
+                timing.start()
+            subpages |= 1 << status
+
+            if progressive:
+                self._FinishFrame(framebuf, roi, 1 << status, status)
+                frame_buffers.publish(self.statistics, context.mode << 1 | status)
+                timing.mark(STAGE_PUBLISH)
+                if half == 0:
+                    framebuf = frame_buffers.back()
+                    framebuf[:] = frame_buffers.front()
+
+        if not progressive:
+            self._FinishFrame(framebuf, roi, subpages)
+            if publish:
+                frame_buffers.publish(self.statistics)
+                timing.mark(STAGE_PUBLISH)
+        return subpages
+
+    def _FinishFrame(self, framebuf, roi, subPages, subPage=-1):
+        """Bad pixels, temporal filter and statistics of the converted frame,
+        or of one subpage in progressive mode"""
+        self._FillBadPixels(framebuf, roi, subPages)
+        timing = self.timing
+        statistics = self.statistics
+        temporalFilter = self.temporal_filter
+        if temporalFilter is not None:
+            timing.start()
+            if roi or subPage >= 0:
+                # the other pixels were filtered when converted
+                mode = self.context.mode
+                pixels = self.roiPixels if roi else self.subPagePixels
+                for filtered in ((0, 1) if subPage < 0 else (subPage,)):
+                    temporalFilter.apply(framebuf, pixels[mode][filtered])
+                statistics.scan(framebuf)
+            else:
+                temporalFilter.apply(framebuf, statistics=statistics)
+            timing.mark(STAGE_FILTER)
+        elif roi:
+            # pixels outside the regions were not converted
+            statistics.scan(framebuf)
+        else:
+            self._MergeStatistics(framebuf, statistics)
+
+    def _FillBadPixels(self, result, roi, subPages):
+        """Fills the bad and out-of-range pixels of the converted subpages (bit
+        flags) with the mean of their good neighbours. Runs once both subpages
+        are in the buffer: in chess mode all neighbours are in the other one"""
+        mode = self.context.mode
+        badPixels = (self.roiBadPixels if roi else self.subPageBadPixels)[mode]
+        interpolate = self.interpolate_bad_pixels
+        rangePixels = self._rangePixels
+        outOfRange = rangePixels[0] + rangePixels[1]
+
+        for subPage in (0, 1):
+            if not subPages >> subPage & 1:
+                continue
+            # out-of-range pixels first, from good neighbours themselves in range
+            patched = [(pixelNumber, [neighbour for neighbour in self._GoodNeighbours(pixelNumber)
+                                      if neighbour not in outOfRange])
+                       for pixelNumber in rangePixels[subPage]]
+            statistics = self._subPageStatistics[subPage]
+            low, lowIndex, high, highIndex, total = statistics
+
+            for pixelNumber, neighbours in patched + badPixels[subPage]:
+                To = -273.15
+                if interpolate and neighbours:
+                    To = 0
+                    for neighbour in neighbours:
+                        To += result[neighbour]
+                    To /= len(neighbours)
+                result[pixelNumber] = To
+                total += To
+                if To < low:
+                    low = To
+                    lowIndex = pixelNumber
+                if To > high:
+                    high = To
+                    highIndex = pixelNumber
+
+            statistics[0] = low
+            statistics[1] = lowIndex
+            statistics[2] = high
+            statistics[3] = highIndex
+            statistics[4] = total
+
+    def frames(self):
+        """Generator of FrameRecord: one per getFrame call (two subpages), with
+        sequence number, capture ticks, converted subpages, Ta/Vdd and the last
+        published frame buffer. In progressive mode getFrame also publishes the
+        first subpage on its own; that frame is not yielded. Failed subpage
+        reads are counted as dropped instead of ending the stream"""
+        record = FrameRecord()
+
+        while True:
+            stamp = time.ticks_ms()
+            wait_time = self.wait_time
+            try:
+                try:
+                    subpages = self.getFrame()
+                except RuntimeError:
+                    # too many retries: slow down
+                    if self.rate_controller is not None:
+                        self.rate_controller.step_down()
+                    raise
+                if self.rate_controller is not None:
+                    busy = time.ticks_diff(time.ticks_ms(), stamp) - (self.wait_time - wait_time)
+                    self.rate_controller.update(busy)
+            except (RuntimeError, ValueError, ZeroDivisionError, OSError):
+                # bad maths, raw data out of range, I2C bus error, also while
+                # changing the refresh rate: drop the frame, keep running
+                self.failed_subpages += 1
+                continue
+
+            record.sequence = frame_buffers.sequence
+            record.ticks = self._lastDataReady
+            record.subpages = subpages
+            record.ta = self.context.ta
+            record.vdd = self.context.vdd
+            record.context = self.context
+            record.buffer = frame_buffers.front()
+            record.dropped = self.missed_subpages + self.failed_subpages
+            record.retries = self.retries
+            record.roi = self.roi_frame
+            yield record
 
     def _GetFrameData(self, frameData):
-        dataReady = 0
         cnt = 0
-        statusRegister = [0]
-        controlRegister = [0]
+        statusRegister = self._statusRegister
+        controlRegister = self._controlRegister
+        timing = self.timing
 
-        while dataReady == 0:
-            self._I2CReadWords(0x8000, statusRegister)
-            dataReady = statusRegister[0] & 0x0008
+        timing.start()
+        dataReady = self._WaitDataReady()
+        readySubPage = statusRegister[0] & 0x0001
+        timing.mark(STAGE_WAIT)
 
         while (dataReady != 0) and (cnt < 5):
             self._I2CWriteWord(0x8000, 0x0030)
@@ -199,16 +789,99 @@ class Sensor:  # pylint: disable=too-many-instance-attributes
             dataReady = statusRegister[0] & 0x0008
             cnt += 1
 
+        self.retries += cnt - 1
         if cnt > 4:
             raise RuntimeError("Too many retries")
 
         self._I2CReadWords(0x800D, controlRegister)
         frameData[832] = controlRegister[0]
-        frameData[833] = statusRegister[0] & 0x0001
-        return frameData[833]
-
-    def _GetTa(self, frameData):
-        vdd = self._GetVdd(frameData)
+        subPage = self._ValidateSubPage(frameData, readySubPage)
+        timing.mark(STAGE_READ)
+        if subPage < 0:
+            return -1
+
+        frameData[833] = subPage
+        if subPage == self._lastSubPage:
+            self.missed_subpages += 1
+        self._lastSubPage = subPage
+        if frameData[800] == self._lastPtat and frameData[810] == self._lastVdd:
+            self._stuckCount += 1
+        else:
+            self._stuckCount = 0
+        self._lastPtat = frameData[800]
+        self._lastVdd = frameData[810]
+        return subPage
+
+    def _ValidateSubPage(self, frameData, readySubPage):
+        """Checks the subpage just read and re-reads only the RAM, without
+        waiting for new data, up to INTEGRITY_RETRIES times. Returns the
+        subpage, or -1 if it kept failing"""
+        statusRegister = self._statusRegister
+        for attempt in range(INTEGRITY_RETRIES + 1):
+            subPage = statusRegister[0] & 0x0001
+            error = self._CheckSubPage(frameData, readySubPage, subPage)
+            if error < 0:
+                return subPage
+            self.integrity_failures[error] += 1
+            if attempt < INTEGRITY_RETRIES:
+                readySubPage = subPage
+                self._I2CReadWords(0x0400, frameData, end=832)
+                self._I2CReadWords(0x8000, statusRegister)
+        return -1
+
+    def _RereadSubPage(self, frameData):
+        """Targeted re-read of the current subpage (RAM and status only).
+        Returns the subpage, or -1"""
+        statusRegister = self._statusRegister
+        readySubPage = frameData[833]
+        self._I2CReadWords(0x0400, frameData, end=832)
+        self._I2CReadWords(0x8000, statusRegister)
+        return self._ValidateSubPage(frameData, readySubPage)
+
+    def _CheckSubPage(self, frameData, readySubPage, subPage):
+        """Returns the failed INTEGRITY_ check, or -1. Raw pixel ranges are
+        checked by _CalculateTo, while converting"""
+        if subPage != readySubPage:
+            return INTEGRITY_SUBPAGE
+        ptat = frameData[800]
+        vdd = frameData[810]
+        if ptat in (0, 0xFFFF) or vdd in (0, 0xFFFF) or frameData[778] in (0, 0xFFFF):
+            return INTEGRITY_INVALID
+        if ptat == self._lastPtat and vdd == self._lastVdd and self._stuckCount + 1 >= STUCK_SUBPAGES:
+            return INTEGRITY_STUCK
+        return -1
+
+    def _WaitDataReady(self):
+        """Sleeps for most of the expected subpage period, computed from the
+        refresh rate and the last data-ready time, and only then polls"""
+        start = time.ticks_ms()
+        period = SUBPAGE_PERIOD_MS >> self._refreshRate
+        statusRegister = self._statusRegister
+
+        if self._lastDataReady is not None:
+            wake = time.ticks_add(self._lastDataReady, period * WAIT_SLEEP_FRACTION // 8)
+            remaining = time.ticks_diff(wake, start)
+            if remaining > 0:
+                time.sleep_ms(remaining)
+                self.sleep_time += remaining
+
+        pollInterval = max(POLL_INTERVAL_MS, period >> 5)
+        while True:
+            if self.data_ready_pin is None or self._dataReadyFlag:
+                self._I2CReadWords(0x8000, statusRegister)
+                self.polls += 1
+                if statusRegister[0] & 0x0008:
+                    break
+            time.sleep_ms(pollInterval)
+
+        self._dataReadyFlag = False
+        self._lastDataReady = time.ticks_ms()
+        self.wait_time += time.ticks_diff(self._lastDataReady, start)
+        return statusRegister[0] & 0x0008
+
+    def _GetTa(self, frameData, vdd=None):
+        if vdd is None:
+            vdd = self._GetVdd(frameData)
 
         ptat = frameData[800]
         if ptat > 32767:
@@ -217,7 +890,7 @@ class Sensor:  # pylint: disable=too-many-instance-attributes
         ptatArt = frameData[768]
         if ptatArt > 32767:
             ptatArt -= 65536
-        ptatArt = (ptat / (ptat * self.alphaPTAT + ptatArt)) * math.pow(2, 18)
+        ptatArt = (ptat / (ptat * self.alphaPTAT + ptatArt)) * 262144
 
         ta = ptatArt / (1 + self.KvPTAT * (vdd - 3.3)) - self.vPTAT25
         ta = ta / self.KtPTAT + 25
@@ -229,33 +902,26 @@ class Sensor:  # pylint: disable=too-many-instance-attributes
             vdd -= 65536
 
         resolutionRAM = (frameData[832] & 0x0C00) >> 10
-        resolutionCorrection = math.pow(2, self.resolutionEE) / math.pow(
-            2, resolutionRAM
-        )
+        resolutionCorrection = (1 << self.resolutionEE) / (1 << resolutionRAM)
         vdd = (resolutionCorrection * vdd - self.vdd25) / self.kVdd + 3.3
 
         return vdd
 
-    def _frame_locked(self, register, index, value):
-        if self._frame_lock.acquire(self.timeout):
-            try:
-                register[index] = value
-            finally:
-                self._frame_lock.release()
-                result = False
-        else:
-            raise Exception("Buffer in use by other process.")
-            result = True
-        return result
-
-    def _CalculateTo(self, frameData, emissivity, tr, result):
-        # pylint: disable=too-many-locals, too-many-branches, too-many-statements
-        subPage = frameData[833]
-        alphaCorrR = [0] * 4
-        irDataCP = [0, 0]
-
-        vdd = self._GetVdd(frameData)
-        ta = self._GetTa(frameData)
+    def _UpdateContext(self, frameData, context):
+        """Computes Vdd, Ta, the reflected temperature and every per-subpage
+        term of the To calculation into context"""
+        context.subpage = subPage = frameData[833]
+        context.mode = mode = (frameData[832] & 0x1000) >> 12
+        context.vdd = vdd = self._GetVdd(frameData)
+        context.ta = ta = self._GetTa(frameData, vdd)
+        tr = self.reflected_temperature
+        if tr is None:
+            # For a MLX90640 in the open air the shift is -8 degC.
+            tr = ta - OPENAIR_TA_SHIFT
+        context.tr = tr
+        context.emissivity = emissivity = self.emissivity
+        context.dTa = ta - 25
+        context.dVdd = vdd - 3.3
 
         ta4 = ta + 273.15
         ta4 = ta4 * ta4
@@ -263,12 +929,9 @@ class Sensor:  # pylint: disable=too-many-instance-attributes
         tr4 = tr + 273.15
         tr4 = tr4 * tr4
         tr4 = tr4 * tr4
-        taTr = tr4 - (tr4 - ta4) / emissivity
-
-        ktaScale = math.pow(2, self.ktaScale)
-        kvScale = math.pow(2, self.kvScale)
-        alphaScale = math.pow(2, self.alphaScale)
+        context.taTr = tr4 - (tr4 - ta4) / emissivity
 
+        alphaCorrR = context.alphaCorrR
         alphaCorrR[0] = 1 / (1 + self.ksTo[0] * 40)
         alphaCorrR[1] = 1
         alphaCorrR[2] = 1 + self.ksTo[1] * self.ct[2]
@@ -278,11 +941,10 @@ class Sensor:  # pylint: disable=too-many-instance-attributes
         gain = frameData[778]
         if gain > 32767:
             gain -= 65536
-        gain = self.gainEE / gain
-
-        # --------- To calculation -------------------------------------
-        mode = (frameData[832] & 0x1000) >> 5
+        context.gain = gain = self.gainEE / gain
 
+        # --------- Compensation pixels --------------------------------
+        irDataCP = context.irDataCP
         irDataCP[0] = frameData[776]
         irDataCP[1] = frameData[808]
         for i in range(2):
@@ -290,116 +952,182 @@ class Sensor:  # pylint: disable=too-many-instance-attributes
                 irDataCP[i] -= 65536
             irDataCP[i] *= gain
 
-        irDataCP[0] -= (
-            self.cpOffset[0]
-            * (1 + self.cpKta * (ta - 25))
-            * (1 + self.cpKv * (vdd - 3.3))
-        )
-        if mode == self.calibrationModeEE:
-            irDataCP[1] -= (
-                self.cpOffset[1]
-                * (1 + self.cpKta * (ta - 25))
-                * (1 + self.cpKv * (vdd - 3.3))
-            )
+        cpCorrection = (1 + self.cpKta * (ta - 25)) * (1 + self.cpKv * (vdd - 3.3))
+        irDataCP[0] -= self.cpOffset[0] * cpCorrection
+        if (mode << 7) == self.calibrationModeEE:
+            irDataCP[1] -= self.cpOffset[1] * cpCorrection
         else:
-            irDataCP[1] -= (
-                (self.cpOffset[1] + self.ilChessC[0])
-                * (1 + self.cpKta * (ta - 25))
-                * (1 + self.cpKv * (vdd - 3.3))
-            )
+            irDataCP[1] -= (self.cpOffset[1] + self.ilChessC[0]) * cpCorrection
+        return context
 
-        for pixelNumber in range(768):
-            if self._IsPixelBad(pixelNumber):
-                if self._frame_locked(result,pixelNumber, -273.15):
+    def _CalculateTo(self, frameData, context, result, roi=False):
+        """Converts the subpage pixels into result. Pixels whose raw word is out
+        of range are skipped, to be patched like bad pixels by _FillBadPixels;
+        returns their number"""
+        # pylint: disable=too-many-locals, too-many-branches, too-many-statements
+        subPage = context.subpage
+        mode = context.mode
+        gain = context.gain
+        emissivity = context.emissivity
+        taTr = context.taTr
+        alphaCorrR = context.alphaCorrR
+
+        # --------- Per-frame constants --------------------------------
+        dTa = context.dTa
+        dVdd = context.dVdd
+        alphaTa = 1 + self.KsTa * dTa
+        tgcCP = self.tgc * context.irDataCP[subPage]
+        ilChessCorrection = (mode << 7) != self.calibrationModeEE
+        ksTo1 = self.ksTo[1]
+        alphaKsTo1 = 1 - ksTo1 * 273.15
+        ct1, ct2, ct3 = self.ct[1], self.ct[2], self.ct[3]
+
+        if roi:
+            pixels = self.roiPixels[mode][subPage]
+        else:
+            pixels = self.subPagePixels[mode][subPage]
+
+        offset = self.offset
+        ktaTable = self.ktaTable
+        kvTable = self.kvTable
+        alphaTable = self.alphaTable
+        ilChessTable = self.ilChessTable
+        fastMath = self._fastMath
+        rootTable = self.rootTable
+        rootBase = self.rootBase
+        rootScale = self.rootScale
+        rootLimit = self.rootLimit
+        sqrt = math.sqrt
+        low = INFINITY
+        high = -INFINITY
+        rawLimit = RAW_LIMIT
+        rawWrap = 0x10000 - RAW_LIMIT
+        rangePixels = self._rangePixels[subPage]
+        rangePixels.clear()
+        lowIndex = highIndex = 0
+        total = 0.0
+
+        for pixelNumber in pixels:
+            irData = frameData[pixelNumber]
+            if irData > 32767:
+                if irData < rawWrap:
+                    rangePixels.append(pixelNumber)
                     continue
+                irData -= 65536
+            elif irData > rawLimit:
+                rangePixels.append(pixelNumber)
+                continue
+            irData *= gain
+
+            irData -= (
+                offset[pixelNumber]
+                * (1 + ktaTable[pixelNumber] * dTa)
+                * (1 + kvTable[pixelNumber] * dVdd)
+            )
 
-            ilPattern = pixelNumber // 32 - (pixelNumber // 64) * 2
-            chessPattern = ilPattern ^ (pixelNumber - (pixelNumber // 2) * 2)
-            conversionPattern = (
-                (pixelNumber + 2) // 4
-                - (pixelNumber + 3) // 4
-                + (pixelNumber + 1) // 4
-                - pixelNumber // 4
-            ) * (1 - 2 * ilPattern)
-
-            if mode == 0:
-                pattern = ilPattern
-            else:
-                pattern = chessPattern
-
-            if pattern == frameData[833]:
-                irData = frameData[pixelNumber]
-                if irData > 32767:
-                    irData -= 65536
-                irData *= gain
-
-                kta = self.kta[pixelNumber] / ktaScale
-                kv = self.kv[pixelNumber] / kvScale
-                irData -= (
-                    self.offset[pixelNumber]
-                    * (1 + kta * (ta - 25))
-                    * (1 + kv * (vdd - 3.3))
-                )
+            if ilChessCorrection:
+                irData += ilChessTable[pixelNumber]
 
-                if mode != self.calibrationModeEE:
-                    irData += (
-                        self.ilChessC[2] * (2 * ilPattern - 1)
-                        - self.ilChessC[1] * conversionPattern
-                    )
+            irData = irData - tgcCP
+            irData /= emissivity
 
-                irData = irData - self.tgc * irDataCP[subPage]
-                irData /= emissivity
+            alphaCompensated = alphaTable[pixelNumber] * alphaTa
 
-                alphaCompensated = SCALEALPHA * alphaScale / self.alpha[pixelNumber]
-                alphaCompensated *= 1 + self.KsTa * (ta - 25)
+            Sx = (
+                alphaCompensated
+                * alphaCompensated
+                * alphaCompensated
+                * (irData + alphaCompensated * taTr)
+            )
+            Sx = sqrt(sqrt(Sx)) * ksTo1
+
+            To = irData / (alphaCompensated * alphaKsTo1 + Sx) + taTr
+            # fourth root, inlined: rootTable lookup and one Newton step
+            # y = (3y + x / y^3) / 4 in fast-math, two square roots otherwise
+            position = (To - rootBase) * rootScale if fastMath else -1
+            if 0 <= position < rootLimit:
+                index = int(position)
+                y = rootTable[index]
+                y += (position - index) * (rootTable[index + 1] - y)
+                To = 0.75 * y + 0.25 * To / (y * y * y) - 273.15
+            else:
+                To = sqrt(sqrt(To)) - 273.15
+
+            if To < ct1:
+                torange = 0
+            elif To < ct2:
+                torange = 1
+            elif To < ct3:
+                torange = 2
+            else:
+                torange = 3
 
-                Sx = (
+            To = (
+                irData
+                / (
                     alphaCompensated
-                    * alphaCompensated
-                    * alphaCompensated
-                    * (irData + alphaCompensated * taTr)
-                )
-                Sx = math.sqrt(math.sqrt(Sx)) * self.ksTo[1]
-
-                To = (
-                    math.sqrt(
-                        math.sqrt(
-                            irData
-                            / (alphaCompensated * (1 - self.ksTo[1] * 273.15) + Sx)
-                            + taTr
-                        )
-                    )
-                    - 273.15
+                    * alphaCorrR[torange]
+                    * (1 + self.ksTo[torange] * (To - self.ct[torange]))
                 )
-
-                if To < self.ct[1]:
-                    torange = 0
-                elif To < self.ct[2]:
-                    torange = 1
-                elif To < self.ct[3]:
-                    torange = 2
-                else:
-                    torange = 3
-
-                To = (
-                    math.sqrt(
-                        math.sqrt(
-                            irData
-                            / (
-                                alphaCompensated
-                                * alphaCorrR[torange]
-                                * (1 + self.ksTo[torange] * (To - self.ct[torange]))
-                            )
-                            + taTr
-                        )
-                    )
-                    - 273.15
-                )
-                if self._frame_locked(result, pixelNumber, To):
-                    continue
+                + taTr
+            )
+            # fourth root, inlined: rootTable lookup and one Newton step
+            # y = (3y + x / y^3) / 4 in fast-math, two square roots otherwise
+            position = (To - rootBase) * rootScale if fastMath else -1
+            if 0 <= position < rootLimit:
+                index = int(position)
+                y = rootTable[index]
+                y += (position - index) * (rootTable[index + 1] - y)
+                To = 0.75 * y + 0.25 * To / (y * y * y) - 273.15
+            else:
+                To = sqrt(sqrt(To)) - 273.15
+            result[pixelNumber] = To
+
+            # --------- Fused statistics -------------------------------
+            total += To
+            if To < low:
+                low = To
+                lowIndex = pixelNumber
+            if To > high:
+                high = To
+                highIndex = pixelNumber
+
+        statistics = self._subPageStatistics[subPage]
+        statistics[0] = low
+        statistics[1] = lowIndex
+        statistics[2] = high
+        statistics[3] = highIndex
+        statistics[4] = total
+        return len(rangePixels)
 
     # pylint: enable=too-many-locals, too-many-branches, too-many-statements
 
+    def _MergeStatistics(self, frame, statistics):
+        """Frame statistics from the last conversion of each subpage"""
+        first, second = self._subPageStatistics
+        if second[0] < first[0]:
+            statistics.minimum, statistics.argmin = second[0], second[1]
+        else:
+            statistics.minimum, statistics.argmin = first[0], first[1]
+        if second[2] > first[2]:
+            statistics.maximum, statistics.argmax = second[2], second[3]
+        else:
+            statistics.maximum, statistics.argmax = first[2], first[3]
+        statistics.total = first[4] + second[4]
+        statistics.centre = (frame[383] + frame[384]) / 2
+
+    def _BuildRootTable(self):
+        """Tabulates x ** 0.25 at ROOT_TABLE_SIZE + 1 evenly spaced points of the
+        Kelvin ** 4 range between ROOT_TABLE_MIN and ROOT_TABLE_MAX"""
+        low = (ROOT_TABLE_MIN + 273.15) ** 4
+        high = (ROOT_TABLE_MAX + 273.15) ** 4
+        step = (high - low) / ROOT_TABLE_SIZE
+        Sensor.rootTable = array('f', [math.sqrt(math.sqrt(low + i * step)) for i in range(ROOT_TABLE_SIZE + 1)])
+        Sensor.rootBase = low
+        Sensor.rootScale = 1 / step
+        Sensor.rootLimit = ROOT_TABLE_SIZE
+        gc.collect()
+
     def _ExtractParameters(self):
         self._ExtractVDDParameters()
         gc.collect()
@@ -429,6 +1157,8 @@ class Sensor:  # pylint: disable=too-many-instance-attributes
         gc.collect()
         self._ExtractDeviatingPixels()
         gc.collect()
+        self._CompileCalibration()
+        gc.collect()
 
     def _ExtractVDDParameters(self):
         # extract VDD
@@ -787,6 +1517,10 @@ class Sensor:  # pylint: disable=too-many-instance-attributes
     def _ExtractDeviatingPixels(self):
         # pylint: disable=too-many-branches
         pixCnt = 0
+        # per instance: a second Sensor (e.g. replaying a log) starts clean
+        self.brokenPixels = []
+        self.outlierPixels = []
+        self.badPixelMap = bytearray(96)
 
         while (
             (pixCnt < 768)
@@ -819,6 +1553,141 @@ class Sensor:  # pylint: disable=too-many-instance-attributes
                 if self._ArePixelsAdjacent(brokenPixel, outlierPixel):
                     raise RuntimeError("Adjacent broken and outlier pixels")
 
+        for pixel in self.brokenPixels + self.outlierPixels:
+            self.badPixelMap[pixel >> 3] |= 1 << (pixel & 0x07)
+
+    def _CompileCalibration(self):
+        """Precomputes, once after EEPROM extraction, the per-pixel terms of
+        _CalculateTo that do not depend on Ta or Vdd"""
+        ktaScale = math.pow(2, self.ktaScale)
+        kvScale = math.pow(2, self.kvScale)
+        alphaScale = SCALEALPHA * math.pow(2, self.alphaScale)
+
+        for pixelNumber in range(768):
+            ilPattern = pixelNumber // 32 - (pixelNumber // 64) * 2
+            chessPattern = ilPattern ^ (pixelNumber - (pixelNumber // 2) * 2)
+            conversionPattern = (
+                (pixelNumber + 2) // 4
+                - (pixelNumber + 3) // 4
+                + (pixelNumber + 1) // 4
+                - pixelNumber // 4
+            ) * (1 - 2 * ilPattern)
+
+            self.ilPattern[pixelNumber] = ilPattern
+            self.chessPattern[pixelNumber] = chessPattern
+            self.conversionPattern[pixelNumber] = conversionPattern
+
+            self.ktaTable[pixelNumber] = self.kta[pixelNumber] / ktaScale
+            self.kvTable[pixelNumber] = self.kv[pixelNumber] / kvScale
+            self.alphaTable[pixelNumber] = alphaScale / self.alpha[pixelNumber]
+            self.ilChessTable[pixelNumber] = (
+                self.ilChessC[2] * (2 * ilPattern - 1)
+                - self.ilChessC[1] * conversionPattern
+            )
+
+        self._CompileSubPages()
+
+    def _CompileSubPages(self):
+        """Builds, for each readout mode, the good pixels refreshed by each
+        subpage and the bad pixels with their good neighbours"""
+        self.subPagePixels = ((array('H'), array('H')), (array('H'), array('H')))
+        self.subPageBadPixels = (([], []), ([], []))
+
+        for pixelNumber in range(768):
+            ilPattern = self.ilPattern[pixelNumber]
+            chessPattern = self.chessPattern[pixelNumber]
+            if self._IsPixelBad(pixelNumber):
+                neighbours = self._GoodNeighbours(pixelNumber)
+                self.subPageBadPixels[0][ilPattern].append((pixelNumber, neighbours))
+                self.subPageBadPixels[1][chessPattern].append((pixelNumber, neighbours))
+            else:
+                self.subPagePixels[0][ilPattern].append(pixelNumber)
+                self.subPagePixels[1][chessPattern].append(pixelNumber)
+
+    def _CompileRegions(self):
+        """Builds the per mode/subpage pixels of ROI frames: the subpage pixels
+        inside a region or on the background grid"""
+        self._roiCount = 0
+        if not self.regions:
+            self.roiPixels = self.roiBadPixels = None
+            return
+
+        mask = bytearray(768)
+        for x, y, width, height in self.regions:
+            for row in range(max(0, y), min(24, y + height)):
+                for column in range(max(0, x), min(32, x + width)):
+                    mask[row * 32 + column] = 1
+        if self.roi_grid:
+            for row in range(0, 24, self.roi_grid):
+                for column in range(0, 32, self.roi_grid):
+                    mask[row * 32 + column] = 1
+
+        self.roiBadPixels = tuple(tuple([bad for bad in badPixels if mask[bad[0]]] for badPixels in mode)
+                                  for mode in self.subPageBadPixels)
+        self.roiPixels = tuple(tuple(array('H', [p for p in pixels if mask[p]]) for pixels in mode)
+                               for mode in self.subPagePixels)
+        gc.collect()
+
+    def _CacheFormat(self):
+        # struct format of the scalar parameters stored after the cache header
+        listSize = 0
+        for name in self._cacheLists:
+            listSize += len(getattr(self, name))
+        return "<%di%df" % (len(self._cacheIntegers), len(self._cacheFloats) + listSize)
+
+    def _SaveCalibration(self, serialNumber):
+        """Stores EEPROM data, extracted parameters and compiled per-pixel
+        tables in a binary file tagged with the sensor serial number"""
+        values = [getattr(self, name) for name in self._cacheIntegers]
+        values += [getattr(self, name) for name in self._cacheFloats]
+        for name in self._cacheLists:
+            values += getattr(self, name)
+        self.offset = array('f', self.offset)
+
+        try:
+            with open(CALIBRATION_CACHE % tuple(serialNumber), "wb") as f:
+                f.write(struct.pack(CACHE_HEADER, CACHE_MAGIC, CACHE_VERSION, *serialNumber))
+                f.write(struct.pack(self._CacheFormat(), *values))
+                for name, _ in self._cacheTables:
+                    f.write(getattr(self, name))
+        except OSError as e:
+            print("Calibration cache not saved:", e)
+        gc.collect()
+
+    def _LoadCalibration(self, serialNumber):
+        """Restores the calibration saved by _SaveCalibration. Returns False,
+        so the EEPROM gets extracted, if there is no valid cache for this sensor"""
+        try:
+            with open(CALIBRATION_CACHE % tuple(serialNumber), "rb") as f:
+                header = struct.unpack(CACHE_HEADER, f.read(struct.calcsize(CACHE_HEADER)))
+                if header[0] != CACHE_MAGIC or header[1] != CACHE_VERSION or list(header[2:]) != list(serialNumber):
+                    return False
+
+                cacheFormat = self._CacheFormat()
+                values = struct.unpack(cacheFormat, f.read(struct.calcsize(cacheFormat)))
+
+                self.offset = array('f', [0] * 768)
+                for name, itemSize in self._cacheTables:
+                    table = getattr(self, name)
+                    if f.readinto(table) != len(table) * itemSize:
+                        return False
+        except (OSError, ValueError):
+            return False
+
+        i = 0
+        for name in self._cacheIntegers + self._cacheFloats:
+            setattr(self, name, values[i])
+            i += 1
+        for name in self._cacheLists:
+            parameters = getattr(self, name)
+            for j in range(len(parameters)):
+                parameters[j] = values[i]
+                i += 1
+
+        self._CompileSubPages()
+        gc.collect()
+        return True
+
     def _UniqueListPairs(self, inputList):
         # pylint: disable=no-self-use
         for i, listValue1 in enumerate(inputList):
@@ -839,18 +1708,24 @@ class Sensor:  # pylint: disable=too-many-instance-attributes
         return False
 
     def _IsPixelBad(self, pixel):
-        if pixel in self.brokenPixels or pixel in self.outlierPixels:
-            return True
+        return (self.badPixelMap[pixel >> 3] >> (pixel & 0x07)) & 0x01 == 1
 
-        return False
+    def _GoodNeighbours(self, pixel):
+        # up, down, left and right neighbours that are not bad pixels
+        row, column = pixel // 32, pixel % 32
+        neighbours = array('H')
+        for i, j in ((row - 1, column), (row + 1, column), (row, column - 1), (row, column + 1)):
+            if 0 <= i < 24 and 0 <= j < 32 and not self._IsPixelBad(32 * i + j):
+                neighbours.append(32 * i + j)
+        return neighbours
 
     def _I2CWriteWord(self, writeAddress, data):
-        cmd = bytearray(4)
+        cmd = self._writeBuffer
         cmd[0] = writeAddress >> 8
         cmd[1] = writeAddress & 0x00FF
         cmd[2] = data >> 8
         cmd[3] = data & 0x00FF
-        dataCheck = [0]
+        dataCheck = self._checkRegister
 
         self.i2c_device.writeto(self.device_address, cmd)
         time.sleep(0.001)
@@ -859,62 +1734,145 @@ class Sensor:  # pylint: disable=too-many-instance-attributes
         #    return -2
 
     def _I2CReadWords(self, addr, buffer, *, end=None):
-        gc.collect()
-        if end is None:
-            remainingWords = len(buffer)
+        """Reads big-endian words from addr straight into buffer, an array('H').
+        The bytes land in the array's own memory and are swapped in place,
+        so steady-state reads do not allocate (the RP2040 is little-endian)"""
+        if end is None or end == len(buffer):
+            words = buffer
         else:
-            remainingWords = end
-        offset = 0
-        addrbuf = bytearray(2)
-
-        while remainingWords:
-            addrbuf[0] = addr >> 8  # MSB
-            addrbuf[1] = addr & 0xFF  # LSB
-            read_words = min(remainingWords, I2C_READ_LEN)
-            self.i2c_device.readfrom_mem_into(self.device_address, addr, self.inbuf[0:read_words*2], addrsize=16)
-            
-            temp = read_words//10
-            temps = [0]
-            for i in range(9):
-                temps.append(temps[i]+temp*2)
-
-
-            for i in range(9):
-                outwords = struct.unpack(
-                    ">" + "H" * temp, self.inbuf[temps[i] : temps[i+1]]
-                )
-                
-                for i, w in enumerate(outwords):
-                    buffer[offset + i] = w
-                offset += temp
-                del outwords
-            
-            outwords = struct.unpack(
-                ">" + "H" * (read_words-9*temp), self.inbuf[temps[9] : read_words*2]
-            )
-            for i, w in enumerate(outwords):
-                buffer[offset + i] = w
-            offset += (read_words-9*temp)
-            del outwords
-            
-            remainingWords -= read_words
-            addr += read_words
-
-    def loop(self):
+            # reuse the memoryview of the last partial read (e.g. the RAM dump)
+            if buffer is not self._viewSource or end != self._viewEnd:
+                self._view = memoryview(buffer)[0:end]
+                self._viewSource = buffer
+                self._viewEnd = end
+            words = self._view
+
+        if len(words) > I2C_READ_LEN:
+            raise ValueError("I2C read too long")
+
+        self.i2c_device.readfrom_mem_into(self.device_address, addr, words, addrsize=16)
+
+        for i in range(len(words)):
+            w = words[i]
+            words[i] = ((w & 0xFF) << 8) | (w >> 8)
+
+    def loop(self, callback=None):
+        """Runs the sensor: callback(record), if given, is called with each
+        FrameRecord, e.g. to follow the GUI's spot with a region of interest"""
         global sensor_running
         
+        frames = self.frames()
+        timing = self.timing
         while True:
-#            stamp = time.ticks_ms()
             if sensor_running:
-                try:
-                    gc.collect()
-                    self.getFrame()
-                    gc.collect()
-                except ValueError:
-                    continue
-#            time.sleep(0.01)
-#            print("Gets one frame from sensor in %0.4f ms" % (time.ticks_diff(time.ticks_ms(), stamp)))        
-            print("Sensor: Used RAM:", gc.mem_alloc(), "Remaining RAM:", gc.mem_free())
+                record = next(frames)
+                if callback is not None:
+                    callback(record)
+                timing.start()
+                gc.collect()
+                timing.mark(STAGE_GC)
+            else:
+                time.sleep_ms(10)
+#            print("Sensor stages (min, mean, p95 us):", timing.report())
+#            print("Sensor: Used RAM:", gc.mem_alloc(), "Remaining RAM:", gc.mem_free())
+
+
+class RateController:
+    """
+        Adaptive refresh rate and I2C clock controller.
+
+        Measures the busy time of each frame (I2C transfers plus conversion,
+        without the data-ready wait) and moves along a ladder of operating
+        points: it steps up when the next point's subpage period leaves enough
+        headroom for several frames in a row, and steps down at once on
+        retries, missed subpages or when the current period is overrun.
+    """
+
+    # (refresh rate, I2C frequency) operating points, slowest first
+    points = ((RefreshRate.REFRESH_0_5_HZ, 400000),
+              (RefreshRate.REFRESH_1_HZ, 400000),
+              (RefreshRate.REFRESH_2_HZ, 400000),
+              (RefreshRate.REFRESH_2_HZ, 1000000),
+              (RefreshRate.REFRESH_4_HZ, 1000000),
+              (RefreshRate.REFRESH_8_HZ, 1000000),
+              (RefreshRate.REFRESH_16_HZ, 1000000),
+              (RefreshRate.REFRESH_32_HZ, 1000000),
+              (RefreshRate.REFRESH_64_HZ, 1000000))
+
+    HEADROOM = 0.75          # fraction of the subpage period the pipeline may use
+    STEP_UP_FRAMES = 8       # consecutive good frames before stepping up
+    HOLD_FRAMES = 64         # frames without stepping up after a step down
+
+    def __init__(self, sensor, rate=RefreshRate.REFRESH_2_HZ, max_rate=RefreshRate.REFRESH_16_HZ, callback=None):
+        self.sensor = sensor
+        self.max_rate = max_rate
+        self.callback = callback                     # called with the controller on every change
+        self.level = 0
+        for level, (point_rate, frequency) in enumerate(self.points):
+            if point_rate <= rate and frequency == I2C_FREQUENCY:
+                self.level = level
+        self.busy = 0                                # busy time per subpage (ms, smoothed)
+        self.good_frames = 0
+        self.hold_frames = 0
+        self.missed_subpages = sensor.missed_subpages
+        self.apply()
+
+    def apply(self):
+        """Programs the sensor with the current operating point"""
+        rate, frequency = self.points[self.level]
+        if frequency != self.sensor.i2c_frequency:
+            self.sensor.set_i2c_frequency(frequency)
+        self.sensor.refresh_rate = rate
+        self.good_frames = 0
+        if self.callback is not None:
+            self.callback(self)
+
+    def label(self):
+        """Operating point as text, eg. '2Hz 400k' """
+        rate, frequency = self.points[self.level]
+        return f"{0.5 * 2 ** rate:g}Hz {frequency // 1000}k"
+
+    def period(self, level):
+        return SUBPAGE_PERIOD_MS >> self.points[level][0]
+
+    def update(self, busy):
+        """Feeds the busy time (ms) of the last two-subpage frame"""
+        self.busy = busy / 2 if self.busy == 0 else (3 * self.busy + busy / 2) / 4
+
+        missed = self.sensor.missed_subpages != self.missed_subpages
+        self.missed_subpages = self.sensor.missed_subpages
+        if missed or self.busy > self.period(self.level):
+            self.step_down()
+            return
+
+        if self.hold_frames > 0:
+            self.hold_frames -= 1
+            return
+
+        level = self.level + 1
+        if level < len(self.points) and self.points[level][0] <= self.max_rate:
+            if self.busy < self.period(level) * self.HEADROOM:
+                self.good_frames += 1
+                if self.good_frames >= self.STEP_UP_FRAMES:
+                    self.level = level
+                    self.apply()
+            else:
+                self.good_frames = 0
+
+    def reset(self):
+        """Restarts the busy time measurement and holds stepping up, eg. when
+        the conversion cost changes (regions of interest on or off)"""
+        self.busy = 0
+        self.good_frames = 0
+        self.hold_frames = self.HOLD_FRAMES
+
+    def step_down(self):
+        """Falls back to the previous operating point"""
+        self.hold_frames = self.HOLD_FRAMES
+        if self.level > 0:
+            self.level -= 1
+            self.apply()
+
 
 # End of driver code
 
@@ -934,10 +1892,30 @@ if __name__=='__main__':
     PRINT_DATA = True
     CYCLE = True
     TEST_LOOP = False
+    BENCHMARK_FAST_MATH = False
     
     WIDTH = 32
     HEIGHT = 24
     
+    # exact vs fast-math conversion of the same subpage
+    if BENCHMARK_FAST_MATH:
+        ROUNDS = 10
+        exact = array('f', [0] * FRAME_SIZE)
+        fast = array('f', [0] * FRAME_SIZE)
+        sensor._GetFrameData(mlx90640Frame)
+        context = sensor._UpdateContext(mlx90640Frame, sensor.context)
+        for fast_math, result in ((False, exact), (True, fast)):
+            sensor.fast_math = fast_math
+            gc.collect()
+            stamp = time.ticks_ms()
+            for _ in range(ROUNDS):
+                sensor._CalculateTo(mlx90640Frame, context, result)
+            elapsed = time.ticks_diff(time.ticks_ms(), stamp) / ROUNDS
+            print("fast_math=%s: %0.1f ms per subpage, max %0.1f frames/s" % (fast_math, elapsed, 500 / elapsed))
+        pixels = sensor.subPagePixels[context.mode][context.subpage]
+        print("Max error: %0.5f degC" % max(abs(exact[p] - fast[p]) for p in pixels))
+        sensor.fast_math = False
+
     # test loop. Uncomment print statements in loop()
     sensor_running = TEST_LOOP
     if TEST_LOOP:
@@ -950,7 +1928,8 @@ if __name__=='__main__':
             stamp = time.ticks_ms()
         try:
             gc.collect()
-            sensor.getFrame(frame)
+            sensor.getFrame()
+            frame = frame_buffers.front()
             gc.collect()
             print("MLX9060 sensor running")
         except ValueError:
@@ -961,6 +1940,8 @@ if __name__=='__main__':
             print()
             print("Read 1 frame in %0.2f ms" % (time.ticks_ms() - stamp))
             print("Used RAM:", gc.mem_alloc(), "Remaining RAM:", gc.mem_free())
+            for name, (low, mean, p95) in sensor.timing.report().items():
+                print("%8s: min %6d us, mean %8.0f us, p95 %6d us" % (name, low, mean, p95))
             print()
 
         if (PRINT_TEMPERATURES or PRINT_COLORS or PRINT_ASCIIART):
@@ -0,0 +1,266 @@
+"""
+Thermal camera
+================================================================================
+
+Simulated MLX90640 sensor:
+
+
+* Author(s): Paulo Teixeira
+
+
+Implementation Notes
+--------------------
+
+    SimulatedI2C stands in for machine.I2C so that Sensor.py runs off-target
+    (CPython on a PC, or a Pico without a sensor): the device keeps the EEPROM,
+    RAM and control registers in 16-bit word arrays, answers readfrom_mem_into
+    and writeto like the MLX90640, and makes a new subpage ready every
+    subpage period of the refresh rate set in the control register (0x800D),
+    toggling the subpage bit of the status register (0x8000).
+
+    RAM frames are synthetic (a warm spot moving over a noisy background) or
+    recorded: any sequence of 832/834-word frames, as dumped from
+    mlx90640Frame. Word 833, when present, gives the subpage of the frame.
+
+    Usage:
+
+        from Simulator import SimulatedI2C
+        from Sensor import Sensor
+        sensor = Sensor(calibration_cache=False, i2c=SimulatedI2C())
+
+"""
+
+import builtins
+import gc
+import time
+from array import array
+
+# MicroPython builtins used by the driver, for CPython hosts
+if not hasattr(builtins, 'const'):
+    builtins.const = lambda value: value
+if not hasattr(time, 'ticks_ms'):
+    TICKS_PERIOD = 1 << 30
+    time.ticks_ms = lambda: int(time.monotonic() * 1000) & (TICKS_PERIOD - 1)
+    time.ticks_us = lambda: int(time.monotonic() * 1000000) & (TICKS_PERIOD - 1)
+    time.ticks_add = lambda ticks, delta: (ticks + delta) & (TICKS_PERIOD - 1)
+    time.ticks_diff = lambda end, start: ((end - start + TICKS_PERIOD // 2) & (TICKS_PERIOD - 1)) - TICKS_PERIOD // 2
+    time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+if not hasattr(gc, 'mem_alloc'):
+    gc.mem_alloc = lambda: 0
+    gc.mem_free = lambda: 0
+
+from Sensor import Sensor, RefreshRate, DEVICE_ADDRESS, SUBPAGE_PERIOD_MS
+
+
+EEPROM_ADDRESS = 0x2400
+RAM_ADDRESS = 0x0400
+REGISTER_ADDRESS = 0x8000
+WORDS = 832                                 # EEPROM and RAM size in words
+REGISTERS = 16                              # 0x8000..0x800F
+STATUS = 0x0                                # 0x8000, offset in registers
+CONTROL = 0xD                               # 0x800D, offset in registers
+DATA_READY = 0x0008
+DEFAULT_CONTROL = 0x1901                    # chess mode, 18 bit, 2Hz: power-on default
+SERIAL_NUMBER = (0x1234, 0x5678, 0x9ABC)
+
+
+def synthetic_eeprom():
+    """832-word EEPROM image with plausible calibration data, one broken
+    pixel (100) and one outlier pixel (300)"""
+    ee = array('H', [0] * WORDS)
+    ee[7], ee[8], ee[9] = SERIAL_NUMBER
+    ee[10] = 0x0499
+    ee[16] = 0x4210
+    ee[17] = 0xFFC4
+    for i in range(18, 24):
+        ee[i] = 0x1122 + i
+    for i in range(24, 32):
+        ee[i] = 0xF0E1 - i
+    ee[32] = 0x4432
+    ee[33] = 0x2F44
+    for i in range(34, 40):
+        ee[i] = 0x2233
+    for i in range(40, 48):
+        ee[i] = 0x1221
+    for i, word in enumerate((0x18EF, 12273, (9 << 10) | 338, 0x9D68, 0x5454, 0x0861, 0x5A5A, 0x5B5B,
+                              0x2363, 0x1009, 0x03B5, 0x0420, 0xF000, 0x9797, 0x9797, 0x1A59)):
+        ee[48 + i] = word
+
+    seed = 1
+    for p in range(768):
+        seed = (seed * 1103515245 + 12345) & 0x7FFFFFFF
+        offset = ((seed >> 8) % 41 - 20) & 0x3F
+        alpha = ((seed >> 16) % 21 - 10) & 0x3F
+        kta = ((seed >> 4) % 7 - 3) & 0x07
+        ee[64 + p] = (offset << 10) | (alpha << 4) | (kta << 1) or 0x0010
+    ee[64 + 100] = 0                        # broken
+    ee[64 + 300] |= 1                       # outlier
+    return ee
+
+
+class SyntheticFrames:
+    """
+        Endless synthetic RAM frames: noisy background with a warm spot that
+        moves one pixel per frame. Gain and compensation pixel words are
+        constant, PTAT and Vdd have a few LSB of noise (about 39 degC ambient,
+        3.3V), as the driver flags a stuck PTAT/Vdd
+    """
+
+    def __init__(self, background=600, spot=200, noise=30):
+        self.background = background
+        self.spot = spot
+        self.noise = noise
+        self.frame = array('H', [0] * WORDS)
+        self.count = 0
+        self._seed = 7
+        frame = self.frame
+        frame[768] = 19442
+        frame[776] = -75 & 0xFFFF
+        frame[778] = 6339
+        frame[800] = 1711
+        frame[808] = -76 & 0xFFFF
+        frame[810] = -13115 & 0xFFFF
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        frame = self.frame
+        spotX = (self.count >> 1) % 32      # two subpages per frame
+        spotY = (self.count >> 6) % 24
+        seed = self._seed
+        for p in range(768):
+            seed = (seed * 1103515245 + 12345) & 0x7FFFFFFF
+            value = self.background + (seed >> 16) % (2 * self.noise + 1) - self.noise
+            if abs(p % 32 - spotX) < 3 and abs(p // 32 - spotY) < 3:
+                value += self.spot
+            frame[p] = value & 0xFFFF
+        frame[800] = 1711 + (seed >> 8) % 5 - 2
+        frame[810] = (-13115 + (seed >> 12) % 5 - 2) & 0xFFFF
+        self._seed = seed
+        self.count += 1
+        return frame
+
+
+class SimulatedI2C:
+    """
+        machine.I2C replacement backed by a simulated MLX90640.
+
+        eeprom: 832 words (default synthetic_eeprom()); frames: iterable of RAM
+        frames (default SyntheticFrames()), recorded sequences are replayed in a loop
+    """
+
+    def __init__(self, eeprom=None, frames=None, control=DEFAULT_CONTROL, address=DEVICE_ADDRESS):
+        self.address = address
+        self.eeprom = array('H', synthetic_eeprom() if eeprom is None else eeprom)
+        self.ram = array('H', [0] * WORDS)
+        self.registers = array('H', [0] * REGISTERS)
+        self.registers[CONTROL] = control
+        self._recorded = frames if isinstance(frames, (list, tuple)) else None
+        self._frames = SyntheticFrames() if frames is None else iter(frames)
+        self._subPage = 1
+        self._lastReady = time.ticks_ms()
+        self.subpages = 0                   # subpages measured so far
+        self.reads = 0
+        self.writes = 0
+
+    def readfrom_mem_into(self, address, memaddr, buf, *, addrsize=16):
+        """Reads words starting at register memaddr into buf, big-endian like
+        the bus. buf is a bytearray or a (little-endian) 16-bit word buffer"""
+        if address != self.address:
+            raise OSError(19)               # ENODEV, like machine.I2C
+        self.reads += 1
+        self._Measure()
+        if isinstance(buf, bytearray):
+            for i in range(len(buf) // 2):
+                word = self._Read(memaddr + i)
+                buf[2 * i] = word >> 8
+                buf[2 * i + 1] = word & 0xFF
+        else:
+            for i in range(len(buf)):
+                word = self._Read(memaddr + i)
+                buf[i] = ((word & 0xFF) << 8) | (word >> 8)
+
+    def writeto(self, address, buf, stop=True):
+        """Writes one word: 2 bytes register address, 2 bytes value (big-endian)"""
+        if address != self.address:
+            raise OSError(19)
+        self.writes += 1
+        register = (buf[0] << 8) | buf[1]
+        value = (buf[2] << 8) | buf[3]
+        if REGISTER_ADDRESS <= register < REGISTER_ADDRESS + REGISTERS:
+            if register - REGISTER_ADDRESS == STATUS:
+                # bits 0..2 (last measured subpage) are read-only
+                value = (self.registers[STATUS] & 0x0007) | (value & 0xFFF8)
+            self.registers[register - REGISTER_ADDRESS] = value
+        elif EEPROM_ADDRESS <= register < EEPROM_ADDRESS + WORDS:
+            self.eeprom[register - EEPROM_ADDRESS] = value
+        return 2
+
+    def subpage_period(self):
+        """Subpage period in ms of the refresh rate in the control register"""
+        return SUBPAGE_PERIOD_MS >> ((self.registers[CONTROL] >> 7) & 0x07)
+
+    def _Read(self, register):
+        if RAM_ADDRESS <= register < RAM_ADDRESS + WORDS:
+            return self.ram[register - RAM_ADDRESS]
+        if EEPROM_ADDRESS <= register < EEPROM_ADDRESS + WORDS:
+            return self.eeprom[register - EEPROM_ADDRESS]
+        if REGISTER_ADDRESS <= register < REGISTER_ADDRESS + REGISTERS:
+            return self.registers[register - REGISTER_ADDRESS]
+        return 0
+
+    def _Measure(self):
+        """Completes the measurement of the next subpage once its period has
+        elapsed: loads a RAM frame, then sets data ready and the subpage bit"""
+        now = time.ticks_ms()
+        period = self.subpage_period()
+        if time.ticks_diff(now, self._lastReady) < period:
+            return
+        self._lastReady = now
+        try:
+            frame = next(self._frames)
+        except StopIteration:
+            if not self._recorded:
+                raise
+            self._frames = iter(self._recorded)
+            frame = next(self._frames)
+        ram = self.ram
+        for i in range(WORDS):
+            ram[i] = frame[i]
+        self._subPage = frame[833] & 0x0001 if len(frame) > 833 else self._subPage ^ 1
+        self.subpages += 1
+        status = self.registers[STATUS]
+        self.registers[STATUS] = (status & 0xFFF8) | DATA_READY | self._subPage
+
+
+if __name__ == '__main__':
+
+    """ Runs Sensor.getFrame on the simulated device and times it"""
+
+    FRAMES = 20
+    RATE = RefreshRate.REFRESH_64_HZ
+    PRINT_ASCIIART = True
+
+    device = SimulatedI2C()
+    sensor = Sensor(calibration_cache=False, i2c=device)
+    sensor.refresh_rate = RATE
+    frame = array('f', [0] * 768)
+
+    stamp = time.ticks_ms()
+    for _ in range(FRAMES):
+        sensor.getFrame(frame)
+    elapsed = time.ticks_diff(time.ticks_ms(), stamp)
+    waiting = sensor.wait_statistics()['wait']
+    print("%d frames in %d ms: %0.1f ms per frame, %0.1f ms of it converting"
+          % (FRAMES, elapsed, elapsed / FRAMES, (elapsed - waiting) / FRAMES))
+    print("I2C reads: %d, writes: %d, subpages measured: %d" % (device.reads, device.writes, device.subpages))
+    print("Ta: %0.2f degC, Vdd: %0.3f V" % (sensor.context.ta, sensor.context.vdd))
+    for name, (low, mean, p95) in sensor.timing.report().items():
+        print("%8s: min %6d us, mean %8.0f us, p95 %6d us" % (name, low, mean, p95))
+
+    if PRINT_ASCIIART:
+        low = min(frame)
+        step = (max(frame) - low) / 6 or 1
+        for h in range(24):
+            print("".join(" .-+*#@"[int((frame[h * 32 + w] - low) / step)] for w in range(32)))
@@ -49,6 +49,7 @@ ERRORS:
 """
 from Display import Display
 from Constants import *
+from array import array
 import time
 import gc
 
@@ -60,37 +61,6 @@ DEBUG_STATES = False
 # Classes
 
 # tools
-class Lock:
-    # resource lock class
-    
-    def __init__(self, lock):
-        self._locked = lock
-
-    def acquire(self, timeout=0):
-        """
-            Tries to acquire the lock in the specified time.
-
-            :param timeout: Maximum time (in seconds) to try to get the lock.
-                            If timeout=0, tries to get immediately.
-            :return: True if lock acquired.
-        """
-        start_time = time.time()
-        
-        while True:
-            if not self._locked:
-                self._locked = True
-                return True
-            if timeout > 0 and (time.time() - start_time) >= timeout:
-                return False
-            # wait to avoid excessive CPU use
-            time.sleep(0.01)  # 10 ms
-
-    def release(self):
-        """
-        Liberate lock.
-        """
-        self._locked = False
-
 def debug_log(func):
     """
     Decorator to log debug messages if DEBUG_STATES is enabled.
@@ -180,7 +150,7 @@ class WindowBase:
         self.type = type
         self.state = IdleState()
         self.data = windows_manager.data
-        self.frame = windows_manager.data.frame
+        self.frame_buffers = windows_manager.data.frame_buffers
         self.pages = windows_manager.data.pages
         self.display = windows_manager.display
         self.configs = windows_manager.data.configs
@@ -812,7 +782,7 @@ class BarWindow(WindowBase):
             self.display.set_block(self.column + column * FIELD_BLOCK_WIDTH,
                                    self.line + line * FIELD_BLOCK_HEIGHT,
                                    FIELD_BLOCK_WIDTH,
-                                   FIELD_BLOCK_HEIGHT)
+                                   FIELD_BLOCK_HEIGHT - 1)
             self.display.fill(self.background_color)
             self.display.show_block()
 
@@ -849,10 +819,11 @@ class BarWindow(WindowBase):
     
     def render_header(self, page, column):
         
+        # header and fields tile the column: overlapping blocks would lose their digests
         self.display.set_block(self.column + column * FIELD_BLOCK_WIDTH,
                                self.line,
                                FIELD_BLOCK_WIDTH,
-                               FIELD_BLOCK_HEIGHT)
+                               FIELD_BLOCK_HEIGHT - 1)
 
         if page['type'] in ['input', 'output']:
             background = self.highlight_color
@@ -878,7 +849,7 @@ class BarWindow(WindowBase):
             self.display.set_block(self.column + column * FIELD_BLOCK_WIDTH,
                                    self.line + line * FIELD_BLOCK_HEIGHT,
                                    FIELD_BLOCK_WIDTH,
-                                   FIELD_BLOCK_HEIGHT + 2)            
+                                   FIELD_BLOCK_HEIGHT - 1)
             if field:
                 if field['active']:
                     if field['highlighted']:                        
@@ -956,8 +927,6 @@ class FrameWindow(WindowBase):
         self.delta = self.maximum - self.minimum
         self.calculate_colors = self.configs.calculate_colors
         self.interpolate_pixels =  self.configs.interpolate_pixels
-        self._frame_lock = Lock(self.data.frame_lock)
-        self.timeout = 1
         self.current_x_pixel, self.current_y_pixel = None, None
         self.x_pixel, self.y_pixel = None, None
         self.pixel_size = FRAME_STEP // 8
@@ -965,35 +934,43 @@ class FrameWindow(WindowBase):
         self.y_pixels =  23
         self.block_pixels =  8
         self.spot_index = None
+        self.rendered_sequence = 0                 # last frame drawn (progressive mode)
+        self.palette = None                        # RGB565 colors of the scanline renderer
+        self.palette_key = None
+        self.palette_scale = 0.0
         
     # class interface
    
     def render(self):
-        self.state.render(self, self.frame)
+        # hold the published frame while rendering: no per-pixel locking needed
+        frame = self.frame_buffers.acquire()
+        try:
+            self.state.render(self, frame)
+        finally:
+            self.frame_buffers.release()
 
     # helper methods
     def get_temperatures(self, frame, index=SOURCE_SIZE):
         """ gets a list of temperatures (center, average, max, min, spot)"""
         
-        if self._frame_lock.acquire(self.timeout):
-            try:
-                # center temperature
-                self.data.temperatures['center'] = (frame[383]+frame[384])/2     
-                # average temperature
-                self.data.temperatures['average'] = sum(frame) / SOURCE_SIZE
-                # maximum temperature
-                self.data.temperatures['max'] = max(frame)
-                # minimum temperature
-                self.data.temperatures['min'] = min(frame)     
-                # temperature at position
-                if index >=0 and index < SOURCE_SIZE:
-                    self.data.temperatures['spot'] = frame[index]
-                elif self.spot_index is not None:
-                        self.data.temperatures['spot'] = frame[self.spot_index]
-            finally:
-                self._frame_lock.release()
-        else:
-            raise Exception("Buffer in use by other process.")
+        # statistics computed by the sensor while converting the frame
+        statistics = self.frame_buffers.statistics_of(frame)
+        # center temperature
+        self.data.temperatures['center'] = statistics.centre
+        # average temperature
+        self.data.temperatures['average'] = statistics.average()
+        # maximum temperature
+        self.data.temperatures['max'] = statistics.maximum
+        # minimum temperature
+        self.data.temperatures['min'] = statistics.minimum
+        # hottest and coldest pixels, for overlays
+        self.data.hot_index = statistics.argmax
+        self.data.cold_index = statistics.argmin
+        # temperature at position
+        if index >=0 and index < SOURCE_SIZE:
+            self.data.temperatures['spot'] = frame[index]
+        elif self.spot_index is not None:
+                self.data.temperatures['spot'] = frame[self.spot_index]
         
     def get_temperature(self, index, frame, interpolate=False):
         """
@@ -1004,14 +981,7 @@ class FrameWindow(WindowBase):
         
         if not interpolate:
             # use pixels from frame
-            if self._frame_lock.acquire(self.timeout):
-                try:
-                    return frame[index]
-                finally:
-                    self._frame_lock.release()
-            else:
-                raise Exception("Buffer in use by other process.")
-                return 
+            return frame[index]
         
         # interpolate new pixels
         pix = 0.0            
@@ -1019,17 +989,11 @@ class FrameWindow(WindowBase):
         q = (index & 0x00000001) + ((index & 0x00000040) >> 5);   
         
         # apply all 4 operations of the kernel
-        if self._frame_lock.acquire(self.timeout):
-            try:
-                for z in range(4):                
-                    
-                    # get and clamp the source adress
-                    sa = (sourceAddress + Interpolation_offsets[q][z]) % SOURCE_SIZE
-                    pix += Kernel[q][z] * frame[sa]
-            finally:
-                self._frame_lock.release()
-        else:
-            raise Exception("Buffer in use by other process.")
+        for z in range(4):                
+            
+            # get and clamp the source adress
+            sa = (sourceAddress + Interpolation_offsets[q][z]) % SOURCE_SIZE
+            pix += Kernel[q][z] * frame[sa]
         return pix                   
 
     def get_color(self, value, type=0):
@@ -1054,6 +1018,20 @@ class FrameWindow(WindowBase):
             (r,g,b) = self.data.colors.colors[ratio]
         return (r & 0xf8) << 8 | (g & 0xfc) << 3 | b >> 3
     
+    def set_palette(self):
+        """ Precomputes the RGB565 color of each palette step (the color scale
+        or PALETTE_STEPS calculated colors) for the current temperature range """
+        
+        key = (self.minimum, self.maximum, self.calculate_colors, self.configs.color_range)
+        if key == self.palette_key:
+            return
+        self.palette_key = key
+        top = PALETTE_STEPS - 1 if self.calculate_colors else self.configs.color_range
+        # color at the middle of each step, so that get_color maps it to that step
+        self.palette = array('H', [self.get_color(self.minimum + self.delta * (k + 0.5) / top)
+                                   for k in range(top + 1)])
+        self.palette_scale = top / self.delta
+
     def set_touch(self, touch_coordinates):  # used to spot a pixel on frame
         """ Gets the (col, lin) of the touched pixel """
         
@@ -1087,6 +1065,12 @@ class FrameWindow(WindowBase):
             index = self.current_x_pixel + y_step * (x_step - self.current_y_pixel - 1)
             
             self.spot_index = None if index < 0 or index >= x_step*y_step else index
+            
+            # sensor pixel of the spot, for the sensor's region of interest
+            if self.spot_index is not None and self.interpolate_pixels:
+                self.data.spot_index = ((self.spot_index >> 1) & 0x1f) + ((self.spot_index >> 7) << 5)
+            else:
+                self.data.spot_index = self.spot_index
 
     def check_button_touch(self, button_field, button_zone):
         """
@@ -1104,6 +1088,7 @@ class FrameWindow(WindowBase):
             self.data.sensor_running = True                   # NEEDS VALIDATION!!!
 
     def clear_window(self):        
+        self.rendered_sequence = 0
         self.display.set_buffer('frame')        
         for line in range(FRAME_BLOCKS_HEIGHT):
             for column in range(FRAME_BLOCKS_WIDTH):
@@ -1138,6 +1123,19 @@ class FrameWindow(WindowBase):
         self.display.set_buffer('frame')
         if frame:
             self.get_temperatures(frame)
+            self.set_palette()
+
+            # progressive sensor: only one subpage changed since the frame on screen
+            tag = self.frame_buffers.tag_of(frame)
+            sequence = self.frame_buffers.sequence_of(frame)
+            follows = self.rendered_sequence and sequence == self.rendered_sequence + 1
+            self.rendered_sequence = sequence
+            if tag >= 0 and follows and not self.interpolate_pixels:
+                if tag >> 1 and not tag & 1:
+                    # chess board: each subpage touches every row, draw them once per pair
+                    return
+                self.render_subpage(frame, tag)
+                return
 
             # for all blocks
             for block_j in range(FRAME_BLOCKS_HEIGHT):
@@ -1146,10 +1144,29 @@ class FrameWindow(WindowBase):
                     block_x = block_i * FRAME_STEP
                     self.display.set_block(block_x, block_y, BLOCK_STEP-1, BLOCK_STEP-1)
                     self.render_frame_block(frame, block_i, block_j, self.interpolate_pixels)
-                    self.display.show_block()
+                    self.display.show_block(track=False)     # new temperatures: always dirty
         else:
             self.clear_window()
 
+    def render_subpage(self, frame, tag):
+        """ Renders only the frame rows changed by the subpage in tag
+        (mode << 1 | subpage), each as a full width row sent on its own:
+        alternate rows (interleaved) or, for the second subpage of a chess
+        board pair, all rows with both subpages """
+
+        chess = tag >> 1
+        subpage = tag & 1
+        size = self.pixel_size
+        width = 32 * size
+        self.display.set_buffer('row')
+        for j in range(24):
+            if not chess and (j & 1) != subpage:
+                continue
+            spot = self.render_row(frame, j * 32, 32, 0, width * 2)
+            if spot is not None:
+                self.display.rect(spot, 0, size, size, self.foreground_color)
+            self.display.show_rows(0, (23 - j) * size, width, size)
+
     def render_frame_block(self, frame, block_i, block_j, interpolate=False):
         """ Renders an individual block of a frame """
 
@@ -1157,22 +1174,54 @@ class FrameWindow(WindowBase):
         j_max =  47 if interpolate else 23
         j_offset = self.block_pixels * block_j
         i_offset = self.block_pixels * block_i
+        size = self.pixel_size
+        row_bytes = FRAME_BLOCK_WIDTH * 2
+        spot = None
 
-        # for all pixels in the block
+        # for all pixel rows in the block
         for pixel_j in range(self.block_pixels):
-            pixel_y = pixel_j * self.pixel_size
+            pixel_y = pixel_j * size
             j = j_max - j_offset - pixel_j
-            for pixel_i in range(self.block_pixels):
-                pixel_x = pixel_i * self.pixel_size
-                i = i_offset + pixel_i
-                index = i + j * j_step
-                color = self.get_color(self.get_temperature(index, frame, interpolate))
-                self.display.fill_rect(pixel_x, pixel_y, self.pixel_size,self.pixel_size, color)
+            spot_x = self.render_row(frame, i_offset + j * j_step, self.block_pixels, pixel_y, row_bytes, interpolate)
+            if spot_x is not None:
+                spot = (spot_x, pixel_y)
                 
-                # if spot is on, shou pixel contour
-                if self.spot_index is not None:
-                    if self.spot_index == index:
-                        self.display.rect(pixel_x, pixel_y, self.pixel_size,self.pixel_size, self.foreground_color)
+        # if spot is on, show pixel contour
+        if spot is not None:
+            self.display.rect(spot[0], spot[1], size, size, self.foreground_color)
+
+    def render_row(self, frame, index, pixels, pixel_y, row_bytes, interpolate=False):
+        """ Renders pixels source pixels from index on as a pixel row at pixel_y
+        of the current buffer: colors its first scanline, one line per pixel,
+        and replicates it down the row. Returns the x of the spot, or None """
+        
+        size = self.pixel_size
+        palette = self.palette
+        top = len(palette) - 1
+        scale = self.palette_scale
+        minimum = self.minimum
+        hline = self.display.hline
+        spot = None
+        
+        for pixel_i in range(pixels):
+            value = self.get_temperature(index, frame, True) if interpolate else frame[index]
+            step = int((value - minimum) * scale)
+            color = palette[0 if step < 0 else top if step > top else step]
+            hline(pixel_i * size, pixel_y, size, color)
+            if index == self.spot_index:
+                spot = pixel_i * size
+            index += 1
+        
+        # replicate the scanline, doubling the copied lines
+        buffer = memoryview(self.display.current_buffer)
+        start = pixel_y * row_bytes
+        done = row_bytes
+        total = size * row_bytes
+        while done < total:
+            count = min(done, total - done)
+            buffer[start + done:start + done + count] = buffer[start:start + count]
+            done += count
+        return spot
 
 # --Manager----------------------------------------------------------------------------------------->>>>>
 
@@ -1338,16 +1387,16 @@ if __name__=='__main__':
     
     # setup context
 
-    # create a dummy frame
-    frame = [0] * 768
-    for j in range(0,24):
-        for i in range(0,32):
-            frame[i+32*j]= i*j/6
-
     # stuff data_bus
     from Data import Payload
     data_bus = Payload()
-    data_bus.frame = frame
+
+    # publish a dummy frame
+    frame = data_bus.frame_buffers.back()
+    for j in range(0,24):
+        for i in range(0,32):
+            frame[i+32*j]= i*j/6
+    data_bus.frame_buffers.publish()
     data_bus.configs.minimum_temperature = 0.0
     data_bus.configs.maximum_temperature = 120.0
     